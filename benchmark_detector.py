@@ -0,0 +1,206 @@
+"""
+Offline accuracy & latency benchmark for the screenshot detector. No discord or network needed.
+Runs the detection pipeline over a local corpus (see misc/corpus.py for the format) and reports per-field accuracy and latency.
+
+Usage:
+    python benchmark_detector.py run corpus --output before.json
+    python benchmark_detector.py run corpus --output after.json --set ocr_mode=readtext --set line_search=legacy
+    python benchmark_detector.py compare before.json after.json
+    python benchmark_detector.py build-glyphs corpus
+"""
+
+import argparse, json, os, time
+from typing import Optional
+
+from misc import detector
+from misc.corpus import load_corpus
+from misc.glyphs import GlyphReader
+from misc.stage_timings import TimingStats
+
+#how far off (in seconds) a detected timer can be from the expected one, to account for rounding and the little time between reading the timer and detection finishing
+TIMER_TOLERANCE = 1
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of values"""
+    if not values: return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered)-1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[idx]
+
+def parse_overrides(pairs: list[str]) -> dict:
+    """Parses `key=value` detector setting overrides, reading the values as JSON where possible"""
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+def check(expected: Optional[dict], result, finished: float) -> Optional[dict]:
+    """
+    Compares a detection result against the expected one, returning which fields were correct (None if unlabelled)
+    The detector works out the capturable time from when it read the timer, so the timer is measured from when detection finished, leaving latency out of it
+    """
+    if expected is None: return None
+
+    if not expected.get("detectable", True):
+        return {"detected": result is None}
+    if result is None:
+        return {"detected": False, "name": False, "tier": False, "timer": False}
+
+    result = result[0]
+    timer = (result.capturable - round(finished)) if result.capturable else None
+    if expected["timer"] is None or timer is None:
+        timer_correct = expected["timer"] == timer
+    else:
+        timer_correct = abs(timer - expected["timer"]) <= TIMER_TOLERANCE
+
+    return {
+        "detected": True,
+        "name": result.name == expected["name"],
+        "tier": result.tier == expected["tier"],
+        "timer": timer_correct
+    }
+
+def summarize(files: dict[str, dict]) -> dict:
+    """Works out the accuracy of each field, and latency percentiles, over all the files in a run"""
+    latencies = [f["latency"] for f in files.values()]
+    summary = {
+        "images": len(files),
+        "p50_latency": percentile(latencies, 50),
+        "p95_latency": percentile(latencies, 95),
+        "accuracy": {}
+    }
+    for field in ("detected", "name", "tier", "timer"):
+        checked = [f["correct"][field] for f in files.values() if f["correct"] and field in f["correct"]]
+        summary["accuracy"][field] = (sum(checked) / len(checked)) if checked else None
+    return summary
+
+def load_settings(overrides: dict) -> dict:
+    """Loads the detector settings from config.json, with any overrides applied"""
+    with open("config.json", "r") as f:
+        config = json.loads(f.read())
+    settings = {**config.get("detector", {}), **overrides}
+    settings["cache_directory"] = config.get("cache_directory", ".cache")
+    return settings
+
+def run(corpus_dir: str, overrides: dict) -> dict:
+    """Runs the detector over every screenshot in a corpus"""
+    settings = load_settings(overrides)
+
+    #run the worker initialization in this process, so the pipeline can be called directly
+    print("Loading the OCR reader...")
+    detector.init_executor(settings)
+
+    corpus = load_corpus(corpus_dir)
+    files = {}
+    stage_stats = TimingStats(window=len(corpus) or 1)
+    for file_name, expected in corpus.items():
+        with open(os.path.join(corpus_dir, file_name), "rb") as f:
+            data = f.read()
+
+        start = time.perf_counter()
+        img = detector.decode_image(data)
+        result = detector.detect_image(img) if img is not None else None
+        latency = time.perf_counter() - start
+        finished = time.time()
+        if result: stage_stats.record(result[0].timings)
+
+        files[file_name] = {
+            "latency": latency,
+            "result": None if result is None else {
+                "name": result[0].name,
+                "tier": result[0].tier,
+                "timer": (result[0].capturable - round(finished)) if result[0].capturable else None
+            },
+            "correct": check(expected, result, finished)
+        }
+        print(f"{file_name}: {latency*1000:.0f}ms, {files[file_name]['result']}")
+
+    print(f"Worker stage timings:\n{stage_stats.summary()}")
+    return {"settings": settings, "files": files, "summary": summarize(files)}
+
+def build_glyphs(corpus_dir: str, overrides: dict):
+    """
+    Builds the glyph templates for the tier and capturability lines, from the lines the OCR read on correctly detected screenshots
+    """
+    #always read with the OCR here, the old templates shouldn't be learning from themselves
+    settings = {**load_settings(overrides), "glyphs": False, "collect_glyphs": True}
+    print("Loading the OCR reader...")
+    detector.init_executor(settings)
+
+    glyph_reader = GlyphReader()
+    learned = 0
+    for file_name, expected in load_corpus(corpus_dir).items():
+        if not expected or not expected.get("detectable", True): continue
+        with open(os.path.join(corpus_dir, file_name), "rb") as f:
+            data = f.read()
+
+        detector.glyph_samples.clear()
+        img = detector.decode_image(data)
+        result = detector.detect_image(img) if img is not None else None
+        finished = time.time()
+
+        #only learn from screenshots that were read completely correctly, so no misread characters get in
+        correct = check(expected, result, finished)
+        if not correct or not all(correct.values()): continue
+        learned += sum(glyph_reader.add(line_img, text) for line_img, text in detector.glyph_samples)
+
+    path = detector.glyph_templates_path(settings)
+    glyph_reader.save(path)
+    print(f"Learned {learned} lines, covering the characters: {''.join(sorted(glyph_reader.chars))}")
+    print(f"Saved the glyph templates to {path}")
+
+def print_summary(label: str, summary: dict):
+    print(f"{label}: {summary['images']} images, p50 {summary['p50_latency']*1000:.0f}ms, p95 {summary['p95_latency']*1000:.0f}ms")
+    for field, accuracy in summary["accuracy"].items():
+        print(f"    {field:<9}" + ("n/a" if accuracy is None else f"{accuracy*100:.1f}%"))
+
+def compare(before: dict, after: dict):
+    """Prints the differences between two runs, including which images changed correctness"""
+    print_summary("Before", before["summary"])
+    print_summary("After ", after["summary"])
+
+    b, a = before["summary"], after["summary"]
+    print(f"Latency change: p50 {(a['p50_latency']-b['p50_latency'])*1000:+.0f}ms, p95 {(a['p95_latency']-b['p95_latency'])*1000:+.0f}ms")
+
+    for file_name, after_file in after["files"].items():
+        before_file = before["files"].get(file_name)
+        if not before_file or before_file["correct"] == after_file["correct"]: continue
+        print(f"Changed: {file_name}: {before_file['correct']} -> {after_file['correct']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the screenshot detector against a local corpus")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Runs the detector over a corpus")
+    run_parser.add_argument("corpus", help="Folder containing the screenshots and corpus.json")
+    run_parser.add_argument("--output", help="File to save the run's results to, for comparing later")
+    run_parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Overrides a detector setting from config.json")
+
+    glyphs_parser = subparsers.add_parser("build-glyphs", help="Builds the glyph templates for the tier and capturability lines from a labelled corpus")
+    glyphs_parser.add_argument("corpus", help="Folder containing the screenshots and corpus.json")
+    glyphs_parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Overrides a detector setting from config.json")
+
+    compare_parser = subparsers.add_parser("compare", help="Compares two saved runs")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        results = run(args.corpus, parse_overrides(args.set))
+        print_summary("Results", results["summary"])
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(json.dumps(results, indent=4))
+    elif args.command == "build-glyphs":
+        build_glyphs(args.corpus, parse_overrides(args.set))
+    else:
+        with open(args.before, "r") as f: before = json.loads(f.read())
+        with open(args.after, "r") as f: after = json.loads(f.read())
+        compare(before, after)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-import asyncio, time
+import asyncio, io, time
 from interactions import (
     Button, ButtonStyle, Extension, Attachment, 
     Embed, EmbedFooter, File,
@@ -7,19 +7,45 @@ from interactions import (
 )
 from interactions.api.events import Startup
 from misc.colors import ERROR_COLOR, KAVANI_COLOR
-from misc.detector import initialize, detect as detect_from_url
+from misc.corpus import add_to_corpus
+from misc.detector import NotReady, Preview, QueueFull, Result, download, initialize, detect as detect_from_url
 from structures.systems import System
 
+#max number of screenshots that can be detected in one command
+MAX_SCREENSHOTS = 6
+
+#how long discord lets us keep responding to an interaction, in seconds
+INTERACTION_LIFETIME = 15 * 60
+
+def extra_screenshot_options(func):
+    """Adds the optional screenshot_2, screenshot_3... options, for detecting several screenshots at once"""
+    #added last-to-first, since each option gets put in front of the ones added before it
+    for i in range(MAX_SCREENSHOTS, 1, -1):
+        func = slash_option(
+            name=f"screenshot_{i}",
+            description="Another screenshot to detect from, at the same time.",
+            required=False, opt_type=OptionType.ATTACHMENT
+        )(func)
+    return func
+
 class Detect(Extension):
 
     @listen(Startup)
     async def startup(self):
-        await initialize()
+        #warm the detector up in the background, so it doesn't hold up the rest of the bot starting
+        self.warmup_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        try:
+            await initialize(self.bot.config)
+        except Exception as e:
+            print(f"Detector failed to initialize: {e}")
+            return
         print("Detector has been initialized.")
 
     @slash_command(
         name="detect",
-        description="Detects system info from a screenshot. Please include the timer, system name, and system tier!"
+        description="Detects system info from screenshots. Please include the timer, system name, and system tier!"
     )
     @cooldown(Buckets.USER, 1, 30)
     @slash_option(
@@ -27,58 +53,134 @@ class Detect(Extension):
         description="The screenshot to detect from.",
         required=True, opt_type=OptionType.ATTACHMENT
     )
-    async def detect(self, ctx: SlashContext, screenshot: Attachment):
-        #make sure the attachment is a valid image type
-        if screenshot.content_type not in ["image/bmp", "image/jpeg", "image/jpg", "image/png"]:
+    @extra_screenshot_options
+    async def detect(self, ctx: SlashContext, screenshot: Attachment, **more_screenshots: Attachment):
+        screenshots = [screenshot, *(s for _, s in sorted(more_screenshots.items()) if s)]
+
+        #make sure the attachments are valid image types
+        for attachment in screenshots:
+            if attachment.content_type not in ["image/bmp", "image/jpeg", "image/jpg", "image/png"]:
+                embed = Embed(
+                    title="Error", color=ERROR_COLOR,
+                    description=f"That screenshot's file type is not supported.\nPlease contact <@!{self.bot.owner.id}> if you think it should be.",
+                    footer=EmbedFooter(f"File type: {attachment.content_type}")
+                )
+                await ctx.send(embeds=embed, ephemeral=True)
+                return
+
+        #keep a status line per screenshot, updating them as the detections finish
+        statuses = ["Detecting..."] * len(screenshots)
+        def progress_embed() -> Embed:
+            if len(screenshots) == 1: return Embed(title=statuses[0], color=KAVANI_COLOR)
+            return Embed(
+                title=f"Detecting {len(screenshots)} screenshots...", color=KAVANI_COLOR,
+                description="\n".join(f"**{i}.** {status}" for i, status in enumerate(statuses, 1))
+            )
+        await ctx.send(ephemeral=True, embeds=progress_embed())
+
+        #give up on detections still stuck in the queue once there wouldn't be time left to confirm them
+        deadline = time.monotonic() + INTERACTION_LIFETIME - 60
+
+        reported = [False] * len(screenshots)
+        async def detect_one(i: int, attachment: Attachment):
+            #let the user know where they are in line, if all the detectors are busy
+            async def on_queued(position: int, wait: int):
+                statuses[i] = f"Waiting for a detector... #{position} in the queue, ~{wait} seconds"
+                await ctx.edit(embeds=progress_embed())
+
+            #only screenshots the detector couldn't read get reported, not ones that failed from timeouts or crashes
+            async def on_failed():
+                reported[i] = True
+                await self.report_failure(attachment)
+
+            try:
+                result = await detect_from_url(attachment.url, on_queued, deadline, on_failed)
+            except QueueFull:
+                statuses[i] = "Too many screenshots are being detected right now, please try again in a minute."
+                result = None
+            else:
+                statuses[i] = f"Detected {result[0].name}" if result else "Detection failed!"
+            await ctx.edit(embeds=progress_embed())
+            return result
+
+        #one screenshot failing unexpectedly shouldn't lose the results of the others
+        results = await asyncio.gather(*(detect_one(i, a) for i, a in enumerate(screenshots)), return_exceptions=True)
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException) and not isinstance(result, NotReady):
+                print(f"Detecting screenshot {i+1} errored with this message: {result!r}")
+                statuses[i] = "Detection failed!"
+                results[i] = None
+
+        not_ready = next((r for r in results if isinstance(r, NotReady)), None)
+        if not_ready:
+            wait = f"Try again in ~{not_ready.remaining} seconds." if not_ready.remaining else f"Please contact <@!{self.bot.owner.id}> if this keeps happening."
             embed = Embed(
                 title="Error", color=ERROR_COLOR,
-                description=f"That screenshot's file type is not supported.\nPlease contact <@!{self.bot.owner.id}> if you think it should be.",
-                footer=EmbedFooter(f"File type: {screenshot.content_type}")
+                description=f"The detector is still warming up!\n{wait}"
             )
-            await ctx.send(embeds=embed, ephemeral=True)
+            await ctx.edit(embeds=embed)
+            await ctx.command.cooldown.reset(ctx)
             return
-        
-        await ctx.send(ephemeral=True, embeds=Embed(
-            title="Detecting...", color=KAVANI_COLOR
-        ))
-        result = await detect_from_url(screenshot.url)
 
         #make sure a result was actually received 
-        if not result:
+        if not any(results):
             embed = Embed(
                 title="Error", color=ERROR_COLOR,
-                description="Image detection failed!\nThis could be because the internal detector failed, or because your screenshot does not have adequate information.",
-                footer=EmbedFooter("This image has been sent to the developer, to hopefully improve future detection.") 
+                description="Image detection failed!\nThis could be because the internal detector failed, or because your screenshot does not have adequate information."
             )
+            if any(reported): embed.set_footer("This image has been sent to the developer, to hopefully improve future detection.")
+            if len(screenshots) > 1: embed.add_field("Details", progress_embed().description)
             await ctx.edit(embeds=embed)
-
-            owner = self.bot.owner
-            await owner.send(f"Image detection failed for the following image: {screenshot.url}")
+            await ctx.command.cooldown.reset(ctx)
             return
-        
-        result, img_buffer = result
-        
-        system, tier = result.name, result.tier
-        is_timer = bool(result.capturable)
-        owner = "Foralkan" if system in self.bot.SYSTEMS["Foralkan"] else "Lycentian"
 
+        #turn the results into system entries, skipping screenshots of the same system
         current_timestamp = int(time.time())
-        capturable_timestamp = result.capturable if is_timer else current_timestamp
+        detections: list[tuple[System, Result, Preview]] = []
+        for detection in results:
+            if not detection: continue
+            result, preview = detection
+            if any(entry.name == result.name for entry, _, _ in detections): continue
+
+            is_timer = bool(result.capturable)
+            owner = "Foralkan" if result.name in self.bot.SYSTEMS["Foralkan"] else "Lycentian"
+            capturable_timestamp = result.capturable if is_timer else current_timestamp
 
-        entry = System(system, owner, tier, capturable_timestamp, current_timestamp, ctx.user.id, None) #type:ignore
+            entry = System(result.name, owner, result.tier, capturable_timestamp, current_timestamp, ctx.user.id, None) #type:ignore
+            detections.append((entry, result, preview))
 
         #SECTION: Get confirmation that the image detection is correct
         
+        #if the detector wasn't sure about a system name, don't accept it automatically
+        needs_confirmation = any(result.needs_confirmation for _, result, _ in detections)
+        accept_note = "Cancelled after 30 seconds unless confirmed" if needs_confirmation else "Accepted after 30 seconds"
+
         #send a confirmation message
+        plural = len(detections) > 1
         conf_embed = Embed(
             title="Confirmation", color=KAVANI_COLOR,
             description="Are these detection results correct?",
-            footer=EmbedFooter("Times are adjusted to your timezone\nAccepted after 30 seconds"),
-        ).add_field("System", entry.get_system_data(), True)
+            footer=EmbedFooter(f"Times are adjusted to your timezone\n{accept_note}"),
+        )
+        failed_count = results.count(None)
+        if failed_count:
+            conf_embed.description += f"\n*{failed_count} screenshot(s) couldn't be detected, and will be skipped.*"
+
+        for entry, result, _ in detections:
+            is_timer = bool(result.capturable)
+            conf_embed.add_field("System", entry.get_system_data(), True)
 
-        #make sure "Immediately" is set for capturable time if it willb e immedieately capturable
-        capturable_value = entry.get_capture_data() if is_timer else "*Immediately*"
-        conf_embed.add_field("Capturable", capturable_value, True)
+            #make sure "Immediately" is set for capturable time if it willb e immedieately capturable
+            capturable_value = entry.get_capture_data() if is_timer else "*Immediately*"
+            conf_embed.add_field("Capturable", capturable_value, True)
+
+            if result.needs_confirmation:
+                runner_up = result.name_match.runner_up if result.name_match else None
+                warning = f"The system name{f' for {entry.name}' if plural else ''} was hard to read, please double check it!"
+                if runner_up: warning += f"\nIt could also be `{runner_up}`."
+                conf_embed.add_field("Warning", warning)
+            elif plural:
+                conf_embed.add_field("\u200b", "\u200b", True) #blank field, to keep each system on its own row
 
         #create confirmation buttons
         conf_buttons = [
@@ -91,48 +193,81 @@ class Detect(Extension):
                 label="No", style=ButtonStyle.DANGER
             )
         ]
-        #create cropped image file
-        image_file = File(img_buffer, "image.png", "Cropped image", "image/png")
+        #create cropped image files, encoding them now if the detector handed back raw pixels
+        image_files = []
+        for i, (_, _, preview) in enumerate(detections, 1):
+            preview_data = await asyncio.to_thread(preview.encode)
+            image_files.append(File(io.BytesIO(preview_data), f"image{i}.{preview.extension}", "Cropped image", preview.mime_type))
 
-        await ctx.edit(embeds=conf_embed, components=conf_buttons, files=[image_file])
-        ctx.message
+        await ctx.edit(embeds=conf_embed, components=conf_buttons, files=image_files)
         
         #this ensures that the user selected confirm. bit messy since we have to handle timeouts
-        #if it timeouts after 30 seconds then this is seen as a confirmation of sending.
+        #if it timeouts after 30 seconds then this is seen as a confirmation of sending (unless a name was unsure)
         try:
             result = await self.bot.wait_for_component(components=conf_buttons, timeout=30)
             if result.ctx.custom_id == "add_system_confirmation_deny":
                 await result.ctx.edit_origin(embeds=Embed(title="Cancelled", color=KAVANI_COLOR), components=[])
                 await ctx.command.cooldown.reset(ctx)
                 return
-        except asyncio.TimeoutError: pass
+        except asyncio.TimeoutError:
+            if needs_confirmation:
+                await ctx.edit(embeds=Embed(title="Cancelled", color=KAVANI_COLOR, description="The detection was not confirmed."), components=[])
+                await ctx.command.cooldown.reset(ctx)
+                return
 
-        #make sure system isn't already reported
-        in_timers = self.bot.timers.has(system)
-        in_capturable = self.bot.capturables.has(system)
-        if in_timers or in_capturable:
-            ex_data: System = (self.bot.timers if in_timers else self.bot.capturables).get(system)
+        #make sure the systems aren't already reported
+        entries = [entry for entry, _, _ in detections]
+        already_listed = [e for e in entries if self.bot.timers.has(e.name) or self.bot.capturables.has(e.name)]
+        if already_listed:
             embed = Embed(
                 title="Error", color=ERROR_COLOR,
-                description=f"The system `{system}` is already listed!\nPlease contact a moderator if you think the current listing is incorrect:"
+                description="Please contact a moderator if you think the current listing is incorrect:"
             )
-            embed.add_field("System", ex_data.get_system_data(), True)
-            if is_timer: 
-                embed.add_field("Capturable", ex_data.get_capture_data(), True)
-            embed.add_field("Added By", ex_data.get_added_data())
-            await ctx.edit(embeds=embed, components=[])
-            await ctx.command.cooldown.reset(ctx)
-            return
+            for entry in already_listed[:8]: #stay within the embed field limit
+                in_timers = self.bot.timers.has(entry.name)
+                ex_data: System = (self.bot.timers if in_timers else self.bot.capturables).get(entry.name)
+                embed.add_field("System", ex_data.get_system_data(), True)
+                if in_timers: 
+                    embed.add_field("Capturable", ex_data.get_capture_data(), True)
+                embed.add_field("Added By", ex_data.get_added_data())
+
+            #if there's nothing else left to add, stop here
+            entries = [e for e in entries if e not in already_listed]
+            if not entries:
+                embed.description = f"{'Those systems are' if plural else f'The system `{already_listed[0].name}` is'} already listed!\n{embed.description}"
+                await ctx.edit(embeds=embed, components=[])
+                await ctx.command.cooldown.reset(ctx)
+                return
+            embed.description = f"Skipped systems that are already listed!\n{embed.description}"
+            await ctx.send(embeds=embed, ephemeral=True)
         
 
-        #if reached here, we know the detection is successful, so send a success message and add teh system to the managers
+        #if reached here, we know the detection is successful, so send a success message and add the systems to the managers
         success_embed = Embed(
             title="Success", color=KAVANI_COLOR,
-            description=f"Successfully added {system}",
-            footer=EmbedFooter("System will be added to list shortly")
+            description=f"Successfully added {', '.join(e.name for e in entries)}",
+            footer=EmbedFooter(f"System{'s' if len(entries) > 1 else ''} will be added to list shortly")
         )
         await ctx.edit(embeds=success_embed, components=[])
 
-        if not is_timer:
+        #commit everything as one batch per manager, so the tracker message only gets re-rendered once
+        timers = [e for e in entries if e.capturable != e.added]
+        capturables = [e for e in entries if e.capturable == e.added]
+        for entry in capturables:
             entry.message_id = await self.bot.logging.log_capturable(entry)
-        await (self.bot.timers if is_timer else self.bot.capturables).add(entry)
\ No newline at end of file
+        await self.bot.timers.add_many(timers)
+        await self.bot.capturables.add_many(capturables)
+
+    async def report_failure(self, screenshot: Attachment):
+        """Sends a screenshot that failed detection to the developer, and saves it into the benchmark corpus"""
+        owner = self.bot.owner
+        await owner.send(f"Image detection failed for the following image: {screenshot.url}")
+
+        #also save it into the local benchmark corpus, so it can be labelled and used for testing detector changes
+        corpus_dir = self.bot.config.get("corpus_directory")
+        if corpus_dir:
+            try:
+                data = await download(screenshot.url)
+                add_to_corpus(corpus_dir, data, screenshot.content_type.split("/")[-1])
+            except Exception as e:
+                print(f"Couldn't save failed screenshot to the corpus: {e}")
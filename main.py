@@ -1,9 +1,13 @@
 import re
-import os, json, time, asyncio
+import os, json, asyncio
 import dotenv; dotenv.load_dotenv()
 import motor.motor_asyncio
-from interactions import Client, Intents, IntervalTrigger, SlashCommand, SlashContext, Task, listen
+from interactions import Client, Intents, SlashCommand, SlashContext, listen
 
+from structures.journal import Journal
+from structures.lease import Lease
+from structures.renderer import RenderScheduler
+from structures.snapshot import Snapshot
 from structures.systems import CapturableManager, TimerManager
 from structures.logger  import Logger
 
@@ -22,27 +26,48 @@ with open(data_path, "r") as data_file:
 
 @listen()
 async def on_ready():
-    #set up the managers for timers and capturable systems
+    #ready fires again every time the bot reconnects to discord, but the journal, managers and background loops must only be set up once
+    if getattr(bot, "started", False): return
+    bot.started = True
+
+    #set up the journal for writing to the db in the background, and the snapshot for starting up without waiting on the db,
+    #then the scheduler for rendering the main message, then the managers for timers and capturable systems
+    journal_path = os.path.join(bot.config.get("cache_directory", ".cache"), "journal.jsonl")
+    bot.journal = await Journal.new(bot.db, journal_path, bot.config.get("journal", {}))
+    snapshot_path = os.path.join(bot.config.get("cache_directory", ".cache"), "snapshot.json")
+    bot.snapshot = Snapshot.new(snapshot_path, bot.config.get("snapshot", {}))
+    bot.renderer = await RenderScheduler.new(bot)
     bot.timers = await TimerManager.new(bot, bot.db["timers"])
     bot.capturables = await CapturableManager.new(bot, bot.db["capturable"])
 
     #set up the logger
     bot.logging = await Logger.new(bot)
     
-    #get interval checking going
-    async def interval():
-        timestamp = int(time.time())
-        to_remove = list(filter(lambda t: t.capturable <= timestamp, bot.timers._systems.values()))
-        for timer in to_remove:
-            await bot.timers.remove(timer.name)
-            await bot.capturables.add(timer, log=False)
+    #only one running instance of the bot (the one holding the lease) expires timers and renders the main message
+    async def on_leader():
+        #clean up any timers that were only half moved over to capturable when the last leader stopped
+        await bot.timers.remove_duplicates(bot.capturables)
+        bot.timers.wake()
+        await bot.timers.update_message()
+        await bot.capturables.update_message()
+    holder_path = os.path.join(bot.config.get("cache_directory", ".cache"), "lease_holder.txt")
+    bot.lease = await Lease.new(bot.db["leases"], holder_path, bot.config.get("lease", {}), on_leader)
+
+    #move timers over to capturable right when they expire (timers that expired while offline are handled immediately)
+    async def on_expired(timers):
+        await bot.timers.move_many(timers, bot.capturables)
+        for timer in timers:
             await bot.logging.log_capturable(timer)
-    await interval() #run initial checks immediately
-    Task(interval, IntervalTrigger(seconds=10)).start()
+    bot.timers.start_expiry(on_expired)
+
+    #keep the systems in sync with changes made by other instances
+    bot.timers.start_sync()
+    bot.capturables.start_sync()
 
     #update the messages initially
     await bot.timers.update_message()
     await bot.capturables.update_message()
+    await bot.renderer.flush()
 
     #update the help message:
     #first, get a list of all the commands in the bot
@@ -0,0 +1,24 @@
+import os, tempfile
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w", fsync: bool = False):
+    """
+    Opens a temporary file to write to, which replaces `path` all at once when the block ends, so nothing ever sees a half written file
+    The temporary file has a unique name, so processes writing the same file at once don't clobber each other's
+    If the block raises, the temporary file is removed and `path` is left as it was
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            if fsync: os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError: pass
+        raise
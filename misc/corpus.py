@@ -0,0 +1,45 @@
+"""
+Handles the local corpus of screenshots used for benchmarking the detector (see benchmark_detector.py)
+A corpus is a folder of screenshots, plus a corpus.json file with the expected detection result for each of them:
+{
+    "some_screenshot.png": {"name": "Pixte", "tier": 2, "timer": 5025}, <- timer is the seconds left shown in the screenshot, or null if capturable
+    "not_capturable.png": {"detectable": false},                        <- the detector should fail on this one
+    "new_screenshot.png": null                                          <- not labelled yet, only used for timing
+}
+"""
+
+import json, os
+from typing import Optional
+
+from misc.result_cache import content_hash
+
+CORPUS_FILE = "corpus.json"
+
+def load_corpus(directory: str) -> dict[str, Optional[dict]]:
+    """Loads the expected results of a corpus, keyed by screenshot file name"""
+    path = os.path.join(directory, CORPUS_FILE)
+    if not os.path.exists(path): return {}
+    with open(path, "r") as f:
+        return json.loads(f.read())
+
+def add_to_corpus(directory: str, data: bytes, extension: str, expected: Optional[dict] = None) -> str:
+    """
+    Saves a screenshot into a corpus, adding its entry to corpus.json (unlabelled, unless `expected` is given)
+    Files are named by the hash of their contents, so reposts of a screenshot are only saved once
+    Returns the file name it was saved under
+    """
+    os.makedirs(directory, exist_ok=True)
+    corpus = load_corpus(directory)
+
+    file_name = f"{content_hash(data)}.{extension}"
+    path = os.path.join(directory, file_name)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    #don't lose the label of a screenshot that's already in the corpus
+    if expected is not None or file_name not in corpus: corpus[file_name] = expected
+    with open(os.path.join(directory, CORPUS_FILE), "w") as f:
+        f.write(json.dumps(corpus, indent=4))
+
+    return file_name
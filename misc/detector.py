@@ -6,60 +6,160 @@ There is also usage of globals, to prevent multiple initializations of OCR reade
 Sorry!
 """
 
-import asyncio, io
-from dataclasses import dataclass
+import asyncio, os, time
+from collections import deque
+from dataclasses import dataclass, field
 from concurrent.futures import ProcessPoolExecutor
-from typing import Optional
+from concurrent.futures.process import BrokenProcessPool
+from typing import Awaitable, Callable, Optional
+
+from misc.glyphs import GlyphReader
+from misc.name_matcher import Match, NameMatcher
+from misc.stage_timings import StageTimer, TimingStats
+
+#the screenshot height that all the detection ratios were measured at (on my 1080p monitor)
+REFERENCE_HEIGHT = 1080
+
+#number of screenshot sizes to remember the panel geometry of, per detection process
+GEOMETRY_CACHE_SIZE = 16
+
+TIERS = [
+    "New Claim",
+    "Outpost",
+    "Garrison",
+    "Stronghold"
+]
 
 @dataclass
 class Result():
     name: str
     tier: int
     capturable: Optional[int]
+    timings: dict[str, float] = field(default_factory=dict) #seconds spent in each stage of the detection
+    name_match: Optional[Match] = None #how sure the system name match was
+    needs_confirmation: bool = False #whether the name match was too unsure to be accepted without the user confirming it
+    panel: Optional[tuple[float, float, float]] = None #(top_y, bottom_y, max_x) of the system info panel crop, as fractions of the screenshot's size
+    panel_hash: Optional[int] = None #perceptual hash of that crop, only worked out when the perceptual cache is enabled
+
+@dataclass
+class Geometry():
+    """Where the system info panel is in a screenshot, worked out from the panel's bar"""
+    bar_rows: tuple[int, int] #y of the bar's top and bottom lines
+    bar_cols: tuple[int, int] #x range covered by the bar's lines
+    bar_height: int
+    max_x: int
+    top_y: int
+    bottom_y: int
+    top_height: int
+
+@dataclass
+class SharedFrame():
+    """Describes a decoded image living in shared memory, so workers can read the pixels without them being pickled"""
+    shm_name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+@dataclass
+class Preview():
+    """
+    The cropped screenshot shown to the user when confirming a detection
+    Either already encoded by the worker, or raw pixels (handed back through shared memory) that get encoded only when they're actually sent
+    """
+    extension: str
+    data: Optional[bytes] = None
+    frame: Optional[SharedFrame] = None
+    pixels: Optional[object] = None #numpy array, once claimed from shared memory
+
+    @property
+    def mime_type(self) -> str:
+        return "image/jpeg" if self.extension == "jpg" else f"image/{self.extension}"
+
+    def claim(self):
+        """Copies raw pixels out of shared memory (in the bot process), freeing the shared memory block"""
+        if not self.frame: return
+        from multiprocessing import shared_memory
+        import numpy as np
 
-def _detect(url) -> Optional[tuple[Result, io.BytesIO]]:
+        shm = shared_memory.SharedMemory(name=self.frame.shm_name)
+        try:
+            self.pixels = np.ndarray(self.frame.shape, dtype=self.frame.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        self.frame = None
+
+    def encode(self) -> bytes:
+        """Gets the encoded image, encoding the raw pixels first if needed"""
+        pixels = self.pixels
+        if self.data is None and pixels is not None:
+            import cv2 as cv
+            self.data = cv.imencode(f".{self.extension}", pixels)[1].tobytes() #type:ignore
+        return self.data or b""
+
+def make_preview(img) -> Preview:
     """
-    Detects system information from an image at a given web URL
+    Creates the preview of a cropped screenshot, in the format and size set in the detector settings:
+    "png", "webp" or "jpg" get encoded right away, while "raw" shares the pixels to be encoded as a png by the bot process later
+    """
+    import cv2 as cv
+    import numpy as np
+
+    #shrink it down if it's wider than needed
+    max_width = settings.get("preview_max_width", 0)
+    if max_width and img.shape[1] > max_width:
+        scale = max_width / img.shape[1]
+        img = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+
+    preview_format = settings.get("preview_format", "png")
+    if preview_format == "raw":
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=img.nbytes)
+        np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[:] = img
+        #the bot process unlinks it once it's claimed the pixels
+        frame = SharedFrame(shm.name, img.shape, img.dtype.str)
+        shm.close()
+        return Preview("png", frame=frame)
+
+    quality = settings.get("preview_quality", 80)
+    params = {
+        "webp": [cv.IMWRITE_WEBP_QUALITY, quality],
+        "jpg": [cv.IMWRITE_JPEG_QUALITY, quality],
+    }.get(preview_format, [])
+    return Preview(preview_format, data=cv.imencode(f".{preview_format}", img, params)[1].tobytes())
+
+def _detect(frame: SharedFrame) -> Optional[tuple[Result, Preview]]:
+    """
+    Detects system information from a decoded image in shared memory
+    """
+    from multiprocessing import shared_memory
+    import numpy as np
+
+    #attach to the frame the bot process put in shared memory, viewing it directly (no copy)
+    shm = shared_memory.SharedMemory(name=frame.shm_name)
+    try:
+        img = np.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)
+        res = detect_image(img)
+        del img #the view has to be gone before the shared memory can be closed
+        return res
+    finally:
+        shm.close()
+
+def detect_image(img) -> Optional[tuple[Result, Preview]]:
+    """
+    Detects system information from a decoded BGR OpenCV image
     """
     try:
         #get the globals for OCR usage and name correction
-        global reader, systems
+        global reader, systems, system_matcher, tier_matcher, glyph_reader
 
         #import libraries for this process
         import re, time
-        from urllib import request
 
         import cv2 as cv
         import numpy as np
         from Levenshtein import distance
 
-        def load_image_from_url(url) -> cv.typing.MatLike:
-            """Loads an image from a URL to a OpenCV image"""
-
-            #add a user-agent to the request, to prevent getting 403'ed
-            opener = request.build_opener()
-            opener.addheaders = [(
-                "User-agent",
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-            )]
-            request.install_opener(opener)
-
-            #make the actual request
-            req = request.urlopen(url)
-
-            #parse it into a OpenCV image
-            #from https://stackoverflow.com/a/21062034
-            arr = np.asarray(bytearray(req.read()), dtype=np.uint8)
-            decoded = cv.imdecode(arr, -1)
-
-            #convert it to 3-length, incase there's an alpha channel
-            return decoded[:, :, :3] # :3
-
-        def pick_closest(item, options):
-            """Returns the closest option and its index to a string `item`, from a list of supplied options"""
-            dists = [distance(item, o) for o in options]
-            idx = int(np.argmin(dists))
-            return (options[idx], idx)
+        timer = StageTimer()
 
         def find_structuring_lines(lines):
             """
@@ -75,39 +175,221 @@ def _detect(url) -> Optional[tuple[Result, io.BytesIO]]:
                     if len_diffs < 3: return line1, line2
                     
             return None, None
-        
-        #read in the image
-        img = load_image_from_url(url)
 
-        #get the "edges" of the image, really just color-filtered to the little 3-part box on a system info screen
-        edges = cv.inRange(img, (55, 55, 55), (65, 65, 65)) #type:ignore
+        def find_structuring_lines_vectorized(lines):
+            """
+            Same as find_structuring_lines (and picks the same pair), but compares all the line lengths at once with numpy
+            """
+            if not lines: return None, None
+            ends = np.array(lines, dtype=np.float64) #shape: (lines, 2 points, xy)
+            lengths = np.hypot(*(ends[:, 0] - ends[:, 1]).T)
+
+            #matrix of which pairs of lines have roughly the same length, ignoring pairs of identical lines
+            flat = ends.reshape(len(ends), -1)
+            close = np.abs(lengths[:, None] - lengths[None, :]) < 3
+            close &= ~(flat[:, None, :] == flat[None, :, :]).all(axis=2)
+
+            #take the first line that has a match, and its first match, like the nested loops would
+            matched = np.flatnonzero(close.any(axis=1))
+            if not len(matched): return None, None
+            i = int(matched[0])
+            return lines[i], lines[int(np.argmax(close[i]))]
+        
+        def readtext_name(sys_name_subsection) -> str:
+            """
+            Reads the name line by running full OCR (text detection + recognition) on the name subsection
+            """
+            #perform OCR reading on the name subsection, sorting the results by their Y position
+            #the system name is the highest text region found (which is why we sorted)
+            with timer.stage("name_ocr"):
+                name_results = reader.readtext(sys_name_subsection, width_ths=1) #type:ignore
+            name_results.sort(key=lambda r:np.average(np.array(r[0])[:,1])) #sort by avg y
+            return name_results[0][1]
+
+        def readtext_bottom(bottom_subsection) -> tuple[str, str]:
+            """
+            Reads the tier and capturability lines by running full OCR on the bottom subsection
+            """
+            #perform OCR on the bottom subsection, sorting by the Y. the tier is first, then the capturability
+            with timer.stage("bottom_ocr"):
+                bottom_results = reader.readtext(bottom_subsection, width_ths=1) #type:ignore
+            bottom_results.sort(key=lambda r:np.average(np.array(r[0])[:,1])) #sort by avg y
+            return bottom_results[0][1], bottom_results[1][1]
 
-        #detect the lines from the edges, and restructure the result into a nicer data format
-        lines = cv.HoughLinesP(edges, 1, np.pi / 180, 100, None, 1, 0)
-        lines = [(l[0][:2], l[0][2:]) for l in lines]
+        def text_bands(section, y_offset: int, count: int, min_height: int) -> Optional[list[list[int]]]:
+            """
+            Finds the boxes of the first `count` rows of text in a section, as [x_min, x_max, y_min, y_max]
+            Text is bright on the dark UI background, so rows/columns with any bright pixels contain text
+            """
+            ink = section.max(axis=2) > 100
+            rows = np.flatnonzero(ink.any(axis=1))
+            if not len(rows): return None
+
+            #split the rows with ink into contiguous bands, ignoring ones too short to be text
+            splits = np.flatnonzero(np.diff(rows) > 1) + 1
+            bands = [b for b in np.split(rows, splits) if len(b) >= min_height][:count]
+            if len(bands) < count: return None
+
+            boxes = []
+            for band in bands:
+                y_min, y_max = int(band[0]), int(band[-1])+1
+                cols = np.flatnonzero(ink[y_min:y_max].any(axis=0))
+                #pad the boxes a bit, the recognizer doesn't like text touching the edges
+                boxes.append([
+                    max(0, int(cols[0])-3), min(section.shape[1], int(cols[-1])+4),
+                    max(0, y_offset+y_min-2), y_offset+y_max+2
+                ])
+            return boxes
+
+        def recognize_boxes(crop, boxes: list[list[int]]) -> Optional[list[tuple[str, float]]]:
+            """
+            Reads the text in the given boxes of the crop by sending all of them through the recognizer in one batch
+            (skipping the slow text detection network), returning the text and confidence of each box, top to bottom
+            """
+            with timer.stage("recognize"):
+                results = reader.recognize( #type:ignore
+                    crop, horizontal_list=boxes, free_list=[],
+                    batch_size=len(boxes), detail=1
+                )
+            if len(results) != len(boxes): return None
+            results.sort(key=lambda r:np.average(np.array(r[0])[:,1])) #sort by avg y, just in case
+            return [(r[1], r[2]) for r in results]
+
+        def glyph_lines(crop, bottom_boxes: list[list[int]]) -> Optional[tuple[str, str]]:
+            """
+            Reads the tier and capturability lines by matching their characters against the glyph templates
+            Returns None if any character didn't match confidently, so the OCR can be used instead
+            """
+            with timer.stage("glyphs"):
+                lines = [glyph_reader.read(crop[y0:y1, x0:x1]) for x0, x1, y0, y1 in bottom_boxes] #type:ignore
+            if min(confidence for _, confidence in lines) < settings.get("glyph_confidence", 0.8): return None
+            return lines[0][0], lines[1][0]
 
-        #get the structuring lines from the list of all of them, exit early if they couldn't be found
-        line1, line2 = find_structuring_lines(lines)
-        if not line1 or not line2: return None
+        def merge_close_lines(lines, tolerance: int = 2):
+            """
+            Drops lines whose endpoints are all within `tolerance` px of a line that's already been kept
+            Shrinking the edges can turn a 1px line into two rows, which would otherwise get paired up as the bar
+            """
+            kept = []
+            for line in lines:
+                flat = np.concatenate(line)
+                if not any(np.abs(flat - np.concatenate(k)).max() <= tolerance for k in kept):
+                    kept.append(line)
+            return kept
+
+        def refine_line(edges, line, scale: float):
+            """
+            Snaps a horizontal line mapped back from the scaled down edges onto the full resolution row it came from,
+            by picking the row around it with the most edge pixels
+            """
+            (x1, y1), (x2, y2) = line
+            if y1 != y2: return line
+            x_min, x_max = sorted((x1, x2))
+            reach = int(np.ceil(1 / scale)) + 1
+            y_min, y_max = max(0, y1 - reach), min(edges.shape[0], y1 + reach + 1)
+            if y_min >= y_max: return line
+            counts = np.count_nonzero(edges[y_min:y_max, x_min:x_max+1], axis=1)
+            y = y_min + int(np.argmax(counts))
+            return ((x1, y), (x2, y))
+
+        def find_geometry(img) -> Optional[Geometry]:
+            """
+            Searches the image for the bar of the system info panel, working out the rest of the panel's geometry from it
+            """
+            #only search the left part of the screen, since that's the only place the system info panel can be
+            #the crop starts from x=0 anyway, so none of the coordinates need adjusting
+            search_width = round(img.shape[1] * settings.get("search_width", 0.5))
+            search_region = img[:, :search_width]
+
+            #get the "edges" of the image, really just color-filtered to the little 3-part box on a system info screen
+            #this is always done on the full resolution pixels, since the thin grey lines get blended out of the color range by any resizing
+            full_edges = cv.inRange(search_region, (55, 55, 55), (65, 65, 65)) #type:ignore
+
+            #for screenshots bigger than 1080p, search for lines on a scaled down version of the edges
+            #INTER_AREA (and keeping anything non-zero) makes sure the 1px wide lines don't get dropped while shrinking
+            scale = 1.0
+            edges = full_edges
+            if settings.get("normalize_resolution", True) and img.shape[0] > REFERENCE_HEIGHT:
+                scale = REFERENCE_HEIGHT / img.shape[0]
+                edges = cv.resize(full_edges, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+                edges = np.where(edges > 0, 255, 0).astype(np.uint8)
+
+            #detect the lines from the edges, and restructure the result into a nicer data format
+            lines = cv.HoughLinesP(edges, 1, np.pi / 180, 100, None, 1, 0)
+            if lines is None: return None
+            lines = [(l[0][:2], l[0][2:]) for l in lines]
+
+            #shrinking can smear a line across two rows, so merge those back into one before pairing up the lines
+            if scale != 1.0:
+                lines = merge_close_lines(lines)
+
+            #get the structuring lines from the list of all of them, exit early if they couldn't be found
+            if settings.get("line_search", "vectorized") == "legacy":
+                line1, line2 = find_structuring_lines(lines)
+            else:
+                line1, line2 = find_structuring_lines_vectorized(lines)
+            if not line1 or not line2: return None
+
+            #map the lines back to the full size image, which the crop (and so the OCR) uses for full detail
+            #then snap them onto the exact full resolution rows, so the bar height isn't off by the scaling error
+            if scale != 1.0:
+                line1, line2 = [tuple(np.round(point / scale).astype(int) for point in line) for line in (line1, line2)]
+                line1, line2 = refine_line(full_edges, line1, scale), refine_line(full_edges, line2, scale)
+
+            #get the maximum x of any of the line vertices, which will be the right-most crop value
+            xs = (line1[0][0], line1[1][0], line2[0][0], line2[1][0])
+            max_x = max(xs)
+
+            #get the height of the bar, adding 1 to account for off-by-one error
+            bar_height = abs(line1[0][1] - line2[0][1])+1
+
+            #get the height of the "bottom" and "top" portions of the crop
+            #these are based on their ratios to the bar height (7px) on my 1080p monitor
+            bottom_height = round((34/7) * bar_height)
+            top_height    = round((51/7) * bar_height)
+
+            #determine the top/bottom y coordinates, by adding the heights from the extremeties of the bar positions
+            bottom_y = max((line1[0][1], line2[0][1])) + bottom_height
+            top_y    = min((line1[0][1], line2[0][1])) - top_height
+
+            return Geometry(
+                (int(line1[0][1]), int(line2[0][1])), (int(min(xs)), int(max_x)),
+                int(bar_height), int(max_x), int(top_y), int(bottom_y), int(top_height)
+            )
+
+        def bar_matches(img, geometry: Geometry) -> bool:
+            """
+            Cheaply checks that the panel's bar is where a cached geometry says it is, by checking the colors of the bar's rows
+            """
+            x_min, x_max = geometry.bar_cols
+            for y in geometry.bar_rows:
+                if not (0 <= y < img.shape[0]) or x_max >= img.shape[1]: return False
+                row = img[y, x_min:x_max+1]
+                on_bar = ((row >= 55) & (row <= 65)).all(axis=1)
+                if on_bar.mean() < 0.9: return False
+            return True
+
+        with timer.stage("line_search"):
+            #screenshots mostly come from a handful of resolutions, so first check if the panel is where it was last time for this size
+            #falling back to the full search for the bar when it isn't
+            size = img.shape[:2]
+            geometry = geometry_cache.get(size)
+            if not geometry or not bar_matches(img, geometry):
+                geometry = find_geometry(img)
+                if not geometry: return None
+                if settings.get("geometry_cache", True):
+                    geometry_cache.pop(size, None)
+                    geometry_cache[size] = geometry
+                    if len(geometry_cache) > GEOMETRY_CACHE_SIZE:
+                        del geometry_cache[next(iter(geometry_cache))]
 
         #SECTION: cropping down the image
-        #get the maximum x of any of the line vertices, which will be the right-most crop value
-        max_x = max((line1[0][0], line1[1][0], line2[0][0], line2[1][0]))
-
-        #get the height of the bar, adding 1 to account for off-by-one error
-        bar_height = abs(line1[0][1] - line2[0][1])+1
-
-        #get the height of the "bottom" and "top" portions of the crop
-        #these are based on their ratios to the bar height (7px) on my 1080p monitor
-        bottom_height = round((34/7) * bar_height)
-        top_height    = round((51/7) * bar_height)
-
-        #determine the top/bottom y coordinates, by adding the heights from the extremeties of the bar positions
-        bottom_y = max((line1[0][1], line2[0][1])) + bottom_height
-        top_y    = min((line1[0][1], line2[0][1])) - top_height
+        bar_height, top_height = geometry.bar_height, geometry.top_height
 
         #perform the crop, cropping from the bottom_y to top_y, and from 0 to the max x
-        img = img[top_y:bottom_y, :max_x]
+        height, width = img.shape[:2]
+        panel = (geometry.top_y / height, geometry.bottom_y / height, geometry.max_x / width)
+        img = img[geometry.top_y:geometry.bottom_y, :geometry.max_x]
         #END SECTION: cropping down the image
 
         #SECTION: Getting the system name
@@ -125,37 +407,56 @@ def _detect(url) -> Optional[tuple[Result, io.BytesIO]]:
         #get the subsection just containing the system name and planet info, 
         #by cropping to the first orange vertical_bar found. if none is found, don't crop
         sys_name_subsection = top_subsection[:, :min(vertical_bars)] if vertical_bars else top_subsection
-        
 
-        #perform OCR reading on the subsection, sorting the results by their Y position
-        results = reader.readtext(sys_name_subsection, width_ths=1) #type:ignore
-        results.sort(key=lambda r:np.average(np.array(r[0])[:,1])) #sort by avg y
+        #get the bottom subsection, which contains the tier and capturability
+        bottom_subsection = img[top_height+bar_height:]
 
-        #determine the system name by:
-        #   1. Picking out the highest text region found (which is why we sorted)
-        #   2. Choosing the closest match out of the Systems list
-        name = pick_closest(results[0][1].split("[")[0].strip(), systems)[0]
+        #read the three lines of text we care about: the system name, the tier, and the capturability
+        #find the boxes of each line from the crop geometry: the name subsection is at the top of the crop, and the bottom one starts right after the bar
+        min_height = max(2, bar_height // 2)
+        name_boxes = text_bands(sys_name_subsection, 0, 1, min_height)
+        bottom_boxes = text_bands(bottom_subsection, top_height+bar_height, 2, min_height)
+        min_confidence = settings.get("min_confidence", 0.4)
+
+        #the tier and capturability are in a fixed font, so try matching them against the glyph templates first (if there are any)
+        name_line, bottom_lines = None, None
+        if glyph_reader and bottom_boxes:
+            bottom_lines = glyph_lines(img, bottom_boxes)
+
+        #then try the cheap recognition-only reading for whatever's left (if enabled),
+        #falling back to full reading for the lines it isn't confident in
+        if settings.get("ocr_mode", "recognize") == "recognize" and name_boxes and bottom_boxes:
+            results = recognize_boxes(img, name_boxes + ([] if bottom_lines else bottom_boxes))
+            if results and results[0][1] >= min_confidence:
+                name_line = results[0][0]
+            if results and not bottom_lines and min(c for _, c in results[1:]) >= min_confidence:
+                bottom_lines = results[1][0], results[2][0]
+        if not name_line:
+            name_line = readtext_name(sys_name_subsection)
+        if not bottom_lines:
+            bottom_lines = readtext_bottom(bottom_subsection)
+        tier_line, capturable_line = bottom_lines
+
+        #when building glyph templates (see benchmark_detector.py), keep the bottom lines to learn from if this detection turns out correct
+        if settings.get("collect_glyphs") and bottom_boxes:
+            glyph_samples.extend(
+                (img[y0:y1, x0:x1].copy(), text) for (x0, x1, y0, y1), text in zip(bottom_boxes, bottom_lines)
+            )
+
+        #determine the system name by choosing the closest match out of the Systems list
+        #if it was a close call between two systems (or nothing matched well), flag it so the user has to confirm it
+        name_match = system_matcher.match(name_line.split("[")[0].strip()) #type:ignore
+        name = name_match.name
+        needs_confirmation = (
+            name_match.score < settings.get("min_name_score", 0.6) or
+            name_match.margin < settings.get("min_name_margin", 0.15)
+        )
         #END SECTION: Getting the system name
 
         #SECTION: Getting the system tier & capturable status
-        #get the bottom subsection
-        bottom_subsection = img[top_height+bar_height:]
-
-        #perform OCR on it, sorting by the Y
-        results = reader.readtext(bottom_subsection, width_ths=1) #type:ignore
-        results.sort(key=lambda r:np.average(np.array(r[0])[:,1])) #sort by avg y
-
         #get the tier by a similar process to system name
         #splitting and joining to hopefully increase accuracy, by removing the first word: the Faction identifier (we dont need it)
-        tier = pick_closest(" ".join(results[0][1].split()[1:]), [
-            "New Claim",
-            "Outpost",
-            "Garrison",
-            "Stronghold"
-        ])[1]
-
-        #pick out the line describing capturability
-        capturable_line = results[1][1]
+        tier = tier_matcher.match(" ".join(tier_line.split()[1:])).index #type:ignore
 
         #if the system says it's not capturable, exit early
         not_capturable = distance(capturable_line, "Cannot be captured") < 5 #account for slignt innaccuracies in the OCR
@@ -184,11 +485,17 @@ def _detect(url) -> Optional[tuple[Result, io.BytesIO]]:
             capturable = (((hours * 60) + mins) * 60) + secs + round(time.time())
 
         #we're finally done, so return the result!
-        #also return the cropped image, as a buffer, tod isplay to the user
-        img_png_encoded = cv.imencode(".png", img)[1]
-        img_buffer = io.BytesIO(img_png_encoded.tobytes())
+        #also return the cropped image, as a preview, to display to the user
+        with timer.stage("encode"):
+            preview = make_preview(img)
 
-        return Result(name, tier, capturable), img_buffer
+        #hash just the panel for the perceptual cache, since the rest of the screen can look the same for different systems
+        panel_hash = None
+        if settings.get("perceptual_cache", False):
+            from misc.result_cache import perceptual_hash
+            panel_hash = perceptual_hash(img)
+
+        return Result(name, tier, capturable, timer.spans, name_match, needs_confirmation, panel, panel_hash), preview
     except Exception as e:
         print("Detector errored with this message:")
         print(e)
@@ -197,12 +504,56 @@ def _detect(url) -> Optional[tuple[Result, io.BytesIO]]:
 #all of this here exists for initializing the globals needed by sub-processes
 reader = None
 systems = None
-def init_executor():
-    from easyocr import Reader
+system_matcher = None
+tier_matcher = None
+glyph_reader = None
+glyph_samples = [] #(line image, text) pairs, only collected when building glyph templates
+geometry_cache: dict[tuple[int, int], Geometry] = {} #image (height, width) -> panel geometry last found at that size, oldest first
+settings = {}
+def load_reader():
+    """
+    Loads the OCR reader, from a pickled copy in the cache directory if there is one
+    Unpickling the whole reader skips building the models and loading their weights from scratch, which makes worker restarts much faster
+    With the "quantize" setting on (the default), the models' linear and LSTM layers are dynamically quantized to int8 for faster CPU inference
+    """
+    import easyocr, torch
+
+    #easyocr applies torch's dynamic int8 quantization itself when running on CPU, this just makes it a choice
+    quantize = settings.get("quantize", True)
+
+    cache_dir = settings.get("cache_directory", ".cache")
+    model_type = "int8" if quantize else "fp32"
+    cache_path = os.path.join(cache_dir, f"easyocr-{easyocr.__version__}-torch-{torch.__version__}-{model_type}.pt")
+    if os.path.exists(cache_path):
+        try:
+            return torch.load(cache_path, weights_only=False)
+        except Exception as e:
+            print(f"Couldn't load the cached OCR reader, rebuilding it: {e}")
+
+    new_reader = easyocr.Reader(["en"], gpu=False, verbose=False, quantize=quantize)
+
+    #save it for next time, all at once so other workers never see half a file
+    from misc.atomic_write import atomic_write
+    try:
+        with atomic_write(cache_path, "wb") as f:
+            torch.save(new_reader, f)
+    except Exception as e:
+        print(f"Couldn't cache the OCR reader: {e}")
+
+    return new_reader
+
+def init_executor(detector_settings: dict):
     import json
-    global reader, systems
+    global reader, systems, system_matcher, tier_matcher, glyph_reader, settings
+    settings = detector_settings
+
+    #split the cores between the workers, so each torch doesn't try to use all of them at once
+    if settings.get("torch_threads"):
+        import torch
+        torch.set_num_threads(settings["torch_threads"])
+
     #initialize the ocr reader
-    reader = Reader(["en"], gpu=False, verbose=False)
+    reader = load_reader()
 
     #initialize the systems
     #ik we already do this in the main.py for the bot, but it seemed inneficient to pass the entire systems array into the subprocess
@@ -212,32 +563,458 @@ def init_executor():
         systems.extend(data["Lycentian"])
         systems.extend(data["Foralkan"])
 
-#create the executor, with 1 CPU core
-executor = ProcessPoolExecutor(1)
+    #build the matchers for correcting OCR'd names once, rather than per detection
+    system_matcher = NameMatcher(systems)
+    tier_matcher = NameMatcher(TIERS)
+
+    #load the glyph templates for the tier and capturability lines, if they've been built (see benchmark_detector.py)
+    glyph_reader = GlyphReader.load(glyph_templates_path(settings)) if settings.get("glyphs", True) else None
+
+def glyph_templates_path(detector_settings: dict) -> str:
+    return detector_settings.get("glyph_templates") or os.path.join(detector_settings.get("cache_directory", ".cache"), "glyphs.npz")
+
+def _warm() -> int:
+    """Does nothing, submitted to new workers so that their initializer (and thus the OCR reader) runs ahead of their first job"""
+    return os.getpid()
+
+
+class QueueFull(Exception):
+    """Raised when a detection is requested while the job queue is already full"""
+
+class DeadlineExceeded(Exception):
+    """Raised when a detection job didn't get a worker, or didn't finish, before its deadline"""
+
+class NotReady(Exception):
+    """Raised when a detection is requested before the detector has finished warming up"""
+    remaining: Optional[int]
+
+    def __init__(self, remaining: Optional[int]):
+        super().__init__(f"Detector is not ready yet (~{remaining}s remaining)")
+        self.remaining = remaining
 
+#called with the position in the queue (1 = next up), and the estimated seconds until the job starts
+QueueCallback = Callable[[int, int], Awaitable[None]]
 
+def _warmup_record_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, "detector_warmup.json")
+
+def _load_warmup_duration(cache_dir: str) -> float:
+    """Gets how long the last worker took to warm up, as an estimate for the next one"""
+    import json
+    try:
+        with open(_warmup_record_path(cache_dir), "r") as f:
+            return float(json.loads(f.read())["seconds"])
+    except Exception:
+        return 60.0
+
+def _save_warmup_duration(cache_dir: str, seconds: float):
+    import json
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(_warmup_record_path(cache_dir), "w") as f:
+            f.write(json.dumps({"seconds": seconds}))
+    except Exception as e:
+        print(f"Couldn't save the detector warm-up time: {e}")
+
+def _process_memory(pid: int) -> int:
+    """Gets the resident memory of a process in bytes, from /proc (so 0 on anything that isn't Linux)"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+    except OSError: pass
+    return 0
+
+class DetectorPool():
+    """
+    A pool of detector worker processes, each holding its own warm OCR reader.
+    Workers are started on demand (up to `max_workers`), and shut down again after sitting idle for `idle_timeout` seconds.
+    Jobs wait in a bounded FIFO queue for the next free worker.
+    """
+    workers: list[ProcessPoolExecutor]
+    max_workers: int
+    min_workers: int
+    idle_timeout: float
+    job_timeout: float
+    queue_size: int
+    average_duration: float
+    warmup_duration: float
+    _worker_settings: dict
+    _idle: list[ProcessPoolExecutor]
+    _last_used: dict[ProcessPoolExecutor, float]
+    _spawning: int
+    _waiting: deque[tuple[asyncio.Future, Optional[QueueCallback]]]
+    _tasks: set[asyncio.Task]
+
+    def __init__(self, worker_settings: dict):
+        self.max_workers = max(1, worker_settings.get("workers", 1))
+        self.min_workers = min(self.max_workers, worker_settings.get("min_workers", 0))
+        self.idle_timeout = worker_settings.get("idle_timeout", 600)
+        self.job_timeout = worker_settings.get("job_timeout", 60)
+        self.queue_size = worker_settings.get("queue_size", 10)
+        self.average_duration = 10.0 #rough guess until real jobs have been timed
+        self.warmup_duration = _load_warmup_duration(worker_settings["cache_directory"])
+
+        self.workers = []
+        self._worker_settings = worker_settings
+        self._idle = []
+        self._last_used = {}
+        self._spawning = 0
+        self._waiting = deque()
+        self._tasks = set()
+
+    async def start(self):
+        """Starts the minimum number of workers, and the task that shuts down idle ones"""
+        await asyncio.gather(*(self._spawn() for _ in range(self.min_workers)))
+        self._run_task(self._shutdown_idle())
+
+    def _run_task(self, coro):
+        """Runs a background task, keeping a reference to it so it doesn't get garbage collected"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _spawn(self, reserved: bool = False):
+        """
+        Starts a new worker process, waits for its OCR reader to load, then hands it to whoever is next in the queue
+        `reserved` means the caller has already counted this worker in `_spawning`
+        """
+        if not reserved: self._spawning += 1
+        #each worker is its own single-process executor, so jobs can be handed to a specific free worker
+        worker = ProcessPoolExecutor(1, initializer=init_executor, initargs=(self._worker_settings,))
+        start = time.monotonic()
+        try:
+            await asyncio.get_event_loop().run_in_executor(worker, _warm)
+        except Exception as e:
+            print(f"Detector worker failed to start: {e}")
+            worker.shutdown(wait=False, cancel_futures=True)
+            self._spawning -= 1
+
+            #if there's nothing left that could pick up the queued jobs, fail them rather than leaving them waiting forever
+            if not self.workers and not self._spawning:
+                while self._waiting:
+                    future, _ = self._waiting.popleft()
+                    if not future.done(): future.set_exception(RuntimeError("No detector workers could be started"))
+            return
+        self._spawning -= 1
+
+        self.warmup_duration = time.monotonic() - start
+        _save_warmup_duration(self._worker_settings["cache_directory"], self.warmup_duration)
+
+        self.workers.append(worker)
+        print(f"Detector worker started in {self.warmup_duration:.1f}s ({self.describe()})")
+        self._release(worker)
+
+    async def _shutdown_idle(self):
+        """Periodically shuts down workers that haven't been used in a while, to give their memory back"""
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            now = time.monotonic()
+            for worker in list(self._idle):
+                if len(self.workers) <= self.min_workers: break
+                if now - self._last_used[worker] < self.idle_timeout: continue
+
+                self._idle.remove(worker)
+                self.workers.remove(worker)
+                del self._last_used[worker]
+                worker.shutdown(wait=False)
+                print(f"Detector worker shut down after being idle ({self.describe()})")
+
+    def _replace(self, worker: ProcessPoolExecutor, kill: bool = False):
+        """
+        Throws away a worker that crashed (or is stuck, if `kill` is set), and starts up a fresh one in its place
+        """
+        if worker in self.workers: self.workers.remove(worker)
+        if worker in self._idle: self._idle.remove(worker)
+        self._last_used.pop(worker, None)
+
+        if kill:
+            #there's no public way to get an executor's processes, so this peeks at its internals
+            for process in list((getattr(worker, "_processes", None) or {}).values()):
+                process.terminate()
+        worker.shutdown(wait=False, cancel_futures=True)
+
+        print(f"Replacing a {'stuck' if kill else 'crashed'} detector worker ({self.describe()})")
+        self._run_task(self._spawn())
+
+    def memory_usage(self) -> int:
+        """Gets the total resident memory of all the worker processes, in bytes"""
+        #there's no public way to get an executor's processes, so this peeks at its internals
+        pids = [pid for w in self.workers for pid in (getattr(w, "_processes", None) or {})]
+        return sum(_process_memory(pid) for pid in pids)
+
+    def describe(self) -> str:
+        """Short summary of the pool's size and memory usage, for logging"""
+        return f"{len(self.workers)}/{self.max_workers} workers running, {self.memory_usage() / 2**20:.0f}MB resident"
+
+    def estimate_wait(self, position: int) -> int:
+        """Estimates the seconds until the job at `position` in the queue gets a worker"""
+        capacity = max(1, len(self.workers) + self._spawning)
+        rounds = -(-position // capacity) #ceiling division
+        wait = rounds * self.average_duration
+
+        #if a worker is still starting up, it's going to be at least that long
+        if self._spawning: wait = max(wait, self.warmup_duration)
+        return round(wait)
+
+    async def _notify(self, callback: QueueCallback, position: int):
+        try:
+            await callback(position, self.estimate_wait(position))
+        except Exception as e:
+            print(f"Queue position callback errored: {e}")
+
+    async def _acquire(self, on_queued: Optional[QueueCallback], deadline: Optional[float]) -> ProcessPoolExecutor:
+        """
+        Waits for a free worker, queueing up (and starting another worker, if there's room) if they're all busy
+        If the job is still queued by `deadline` (a time.monotonic() time), it's dropped from the queue
+        """
+        if self._idle and not self._waiting:
+            return self._idle.pop()
+
+        if len(self._waiting) >= self.queue_size:
+            raise QueueFull()
+
+        future = asyncio.get_event_loop().create_future()
+        self._waiting.append((future, on_queued))
+
+        #scale up if there are more jobs waiting than workers already on their way
+        if len(self._waiting) > self._spawning and len(self.workers) + self._spawning < self.max_workers:
+            #counted straight away, so the wait estimate below already includes it
+            self._spawning += 1
+            self._run_task(self._spawn(reserved=True))
+
+        if on_queued: await self._notify(on_queued, len(self._waiting))
+
+        try:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            #wait_for has already cancelled the future, so it just needs taking out of the queue
+            self._waiting = deque(w for w in self._waiting if w[0] is not future)
+            raise DeadlineExceeded("Job expired while waiting in the queue")
+        except asyncio.CancelledError:
+            #if we got cancelled after being handed a worker, give it back
+            if future.done() and not future.cancelled():
+                self._release(future.result())
+            else:
+                self._waiting = deque(w for w in self._waiting if w[0] is not future)
+            raise
+
+    def _release(self, worker: ProcessPoolExecutor):
+        """Hands a worker to the next job in the queue, or marks it as idle"""
+        self._last_used[worker] = time.monotonic()
+        while self._waiting:
+            future, _ = self._waiting.popleft()
+            if future.done(): continue
+            future.set_result(worker)
+
+            #let everyone still waiting know they moved up
+            for position, (_, callback) in enumerate(self._waiting, 1):
+                if callback: self._run_task(self._notify(callback, position))
+            return
+
+        self._idle.append(worker)
+
+    async def run(self, fn, *args, on_queued: Optional[QueueCallback] = None, deadline: Optional[float] = None):
+        """
+        Runs `fn(*args)` on the next free worker, giving up on it if it's still queued at `deadline`
+        If the job takes longer than `job_timeout`, or crashes its worker, the worker gets replaced with a fresh one
+        """
+        worker = await self._acquire(on_queued, deadline)
+        start = time.monotonic()
+        loop = asyncio.get_event_loop()
+        try:
+            res = await asyncio.wait_for(loop.run_in_executor(worker, fn, *args), self.job_timeout)
+        except asyncio.TimeoutError:
+            self._replace(worker, kill=True)
+            raise DeadlineExceeded(f"Job took longer than {self.job_timeout} seconds")
+        except BrokenProcessPool:
+            self._replace(worker)
+            raise
+        except asyncio.CancelledError:
+            #the job keeps running in the worker, but it'll still be usable once it's done
+            self._release(worker)
+            raise
+
+        #keep a moving average of job durations, for queue time estimates
+        self.average_duration = (self.average_duration * 0.8) + ((time.monotonic() - start) * 0.2)
+        self._release(worker)
+        return res
+
+
+#SECTION: fetching screenshots, done in the bot process so the workers only ever do CV and OCR
+_session = None
+def get_session():
+    """Gets the shared HTTP session for downloading screenshots, creating it on first use"""
+    import aiohttp
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            #add a user-agent to the requests, to prevent getting 403'ed
+            headers={"User-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"},
+            connector=aiohttp.TCPConnector(limit=10),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+    return _session
+
+async def download(url: str) -> bytes:
+    """Downloads the raw (encoded) bytes of a screenshot"""
+    async with get_session().get(url) as response:
+        response.raise_for_status()
+        return await response.read()
+
+def decode_image(data: bytes):
+    """
+    Decodes raw image bytes into a 3-channel BGR OpenCV image
+    Always at full resolution: the panel's 1px lines don't survive a reduced size decode
+    """
+    import cv2 as cv
+    import numpy as np
+
+    #from https://stackoverflow.com/a/21062034
+    #IMREAD_COLOR drops any alpha channel for us, and converts grayscale images to 3 channels
+    arr = np.frombuffer(data, dtype=np.uint8)
+    return cv.imdecode(arr, cv.IMREAD_COLOR)
+
+def share_image(img):
+    """Copies a decoded image into a new block of shared memory. The caller is responsible for unlinking it"""
+    from multiprocessing import shared_memory
+    import numpy as np
+
+    shm = shared_memory.SharedMemory(create=True, size=img.nbytes)
+    np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[:] = img
+    return shm, SharedFrame(shm.name, img.shape, img.dtype.str)
+#END SECTION: fetching screenshots
+
+
+pool: Optional[DetectorPool] = None
+cache = None
+timing_stats = TimingStats()
+perceptual_cache = False
 initialized = False
-async def initialize():
+
+#SECTION: warm-up tracking, so /detect can tell people how long until it's usable
+warmup_state = "cold" #one of "cold", "warming", "ready" or "failed"
+warmup_started = 0.0
+expected_warmup = 60.0
+
+def warmup_remaining() -> Optional[int]:
+    """Estimates the seconds until the detector is ready, or None if it isn't going to be (not started, or failed)"""
+    if warmup_state != "warming": return None
+    return max(1, round(expected_warmup - (time.monotonic() - warmup_started)))
+#END SECTION: warm-up tracking
+
+async def initialize(config: dict):
     """
-    Runs the initialization inside the executor
+    Creates the detector pool from the "detector" section of the config, and starts its minimum number of workers
+    Safe to run in the background: until it finishes, detect() raises NotReady
     """
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(executor, init_executor)
-    
-    global initialized
+    global warmup_state, warmup_started, expected_warmup
+    expected_warmup = _load_warmup_duration(config.get("cache_directory", ".cache"))
+    warmup_started = time.monotonic()
+    warmup_state = "warming"
+    try:
+        await _initialize(config)
+    except Exception:
+        warmup_state = "failed"
+        raise
+
+    warmup_state = "ready"
+
+async def _initialize(config: dict):
+    from misc.result_cache import ResultCache
+    global pool, cache, timing_stats, perceptual_cache, initialized
+    detector_settings = dict(config.get("detector", {}))
+    detector_settings["cache_directory"] = config.get("cache_directory", ".cache")
+    #split the cores based on the max number of workers, since that's how many could be running at once
+    worker_count = max(1, detector_settings.get("workers", 1))
+    detector_settings["torch_threads"] = detector_settings.get("torch_threads") or max(1, (os.cpu_count() or 1) // worker_count)
+
+    cache = ResultCache(
+        detector_settings.get("cache_size", 256),
+        detector_settings.get("cache_ttl", 900),
+        detector_settings.get("perceptual_cache_distance", 4)
+    )
+    perceptual_cache = detector_settings.get("perceptual_cache", False)
+    timing_stats = TimingStats(slow_threshold=detector_settings.get("slow_threshold", 0))
+
+    pool = DetectorPool(detector_settings)
+    await pool.start()
     initialized = True
 
 #the actual detection function, relatively simple compared to the rest of this lol
-async def detect(url) -> Optional[tuple[Result, io.BytesIO]]:
+async def detect(
+        url, on_queued: Optional[QueueCallback] = None, deadline: Optional[float] = None,
+        on_failed: Optional[Callable[[], Awaitable[None]]] = None
+    ) -> Optional[tuple[Result, Preview]]:
     """
     Detects info from contested system info screens, at the provided web URL
-    Returns None if the detection has failed
+    Returns None if the detection has failed, raises QueueFull if there are too many detections waiting,
+    and raises NotReady if the detector is still warming up
+    `on_queued` gets called with the queue position and estimated wait, whenever the job has to wait for a worker
+    `deadline` is the time.monotonic() time after which nobody cares about the result any more (e.g. the interaction expired)
+    `on_failed` gets called only when the detector actually looked at the screenshot and couldn't find the info,
+    not when the job itself failed (download errors, deadlines, crashed workers)
     """
-    global initialized
-    if not initialized:
-        print("Detect was called without the detector being initialized!")
-        return None
+    if not initialized or not pool:
+        raise NotReady(warmup_remaining())
 
-    loop = asyncio.get_event_loop()
-    res = await loop.run_in_executor(executor, _detect, url)
-    return res
\ No newline at end of file
+    from misc.result_cache import content_hash, perceptual_hash
+    timer = StageTimer()
+    res = None
+    try:
+        #download and decode the screenshot here, so the network wait doesn't hold up a worker
+        try:
+            with timer.stage("download"):
+                data = await download(url)
+
+            #if this exact screenshot has been detected before, reuse that
+            digest = content_hash(data)
+            if cache and (res := cache.get(digest)): return res
+
+            with timer.stage("decode"):
+                img = await asyncio.to_thread(decode_image, data)
+        except Exception as e:
+            print(f"Downloading the screenshot failed: {e}")
+            return None
+        if img is None: #not actually an image
+            if on_failed: await on_failed()
+            return None
+
+        #also check for re-encoded copies of a screenshot that's been detected before, if enabled
+        phash = perceptual_hash(img) if perceptual_cache else None
+        if cache and phash is not None and (res := cache.get_similar(img, phash)): return res
+        if cache: cache.miss()
+
+        #hand the pixels to the worker through shared memory
+        shm, frame = share_image(img)
+        del img
+        try:
+            #this stage covers waiting in the queue, plus sending the job to and from the worker
+            with timer.stage("detector"):
+                res = await pool.run(_detect, frame, on_queued=on_queued, deadline=deadline)
+        except QueueFull:
+            raise
+        except Exception as e:
+            #deadlines, crashed workers, workers that failed to start (e.g. running out of memory loading the models), or anything else the worker raised
+            print(f"Detection job failed: {e!r}")
+            return None
+        finally:
+            shm.close()
+            shm.unlink()
+
+        #take the preview's pixels out of shared memory straight away, so it doesn't leak if it's never sent
+        if res: res[1].claim()
+        elif on_failed: await on_failed()
+
+        if res and cache: cache.put(digest, phash, *res)
+        return res
+    finally:
+        #combine the stages from this process with the ones from the worker (or replace them, for cached results)
+        if res:
+            timer.spans["total"] = sum(timer.spans.values())
+            res[0].timings = {**(res[0].timings if "detector" in timer.spans else {}), **timer.spans}
+            timing_stats.record(res[0].timings)
+            if timing_stats.count % 50 == 0:
+                print(f"Detection timings over the last {timing_stats.window} detections:\n{timing_stats.summary()}")
+                if cache: print(f"Result cache: {cache.stats()}")
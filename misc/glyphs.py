@@ -0,0 +1,135 @@
+"""
+Template matching for the fixed-font text on the system info panel (the tier, and the "Capturable in h:mm:ss" line)
+Since the game always renders these with the same font, each character looks (almost) the same every time,
+so matching against saved templates of each character is much cheaper than running neural OCR on them.
+
+Templates are harvested from lines that the OCR read confidently on labelled screenshots,
+see the `build-glyphs` command in benchmark_detector.py
+"""
+
+from typing import Optional
+
+#size every glyph gets normalized to before comparing
+GLYPH_HEIGHT = 20
+GLYPH_WIDTH = 16
+
+def ink_mask(line_img):
+    """Picks out the (bright) text pixels of a line on the dark UI background"""
+    return line_img.max(axis=2) > 100
+
+def segment(ink) -> list[tuple[int, int]]:
+    """Splits a line into glyphs, as (start, end) column ranges separated by columns without any ink"""
+    import numpy as np
+    cols = np.flatnonzero(ink.any(axis=0))
+    if not len(cols): return []
+    splits = np.flatnonzero(np.diff(cols) > 1) + 1
+    return [(int(run[0]), int(run[-1])+1) for run in np.split(cols, splits)]
+
+def normalize(glyph_ink):
+    """Resizes a glyph's ink to the standard glyph size, centered so it can be compared with a correlation"""
+    import cv2 as cv
+    import numpy as np
+    resized = cv.resize(glyph_ink.astype(np.float32), (GLYPH_WIDTH, GLYPH_HEIGHT), interpolation=cv.INTER_AREA)
+    centered = resized - resized.mean()
+    norm = np.linalg.norm(centered)
+    return centered / norm if norm else centered
+
+class GlyphReader():
+    """
+    Reads lines of fixed-font text by matching each character against its template
+    """
+    _sums: dict[str, object] #char -> sum of normalized glyphs (numpy arrays)
+    _widths: dict[str, float] #char -> sum of glyph width / line height ratios
+    _counts: dict[str, int]
+
+    def __init__(self):
+        self._sums = {}
+        self._widths = {}
+        self._counts = {}
+
+    @classmethod
+    def load(cls, path: str) -> Optional["GlyphReader"]:
+        """Loads saved templates, or returns None if there aren't any"""
+        import os
+        import numpy as np
+        if not os.path.exists(path): return None
+
+        self = cls()
+        data = np.load(path)
+        for char, glyph_sum, width, count in zip(data["chars"], data["sums"], data["widths"], data["counts"]):
+            self._sums[str(char)] = glyph_sum
+            self._widths[str(char)] = float(width)
+            self._counts[str(char)] = int(count)
+        return self
+
+    def save(self, path: str):
+        import os
+        import numpy as np
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        chars = list(self._sums)
+        np.savez(
+            path, chars=np.array(chars),
+            sums=np.array([self._sums[c] for c in chars]),
+            widths=np.array([self._widths[c] for c in chars]),
+            counts=np.array([self._counts[c] for c in chars])
+        )
+
+    @property
+    def chars(self) -> list[str]:
+        return list(self._sums)
+
+    def _glyphs(self, line_img) -> tuple[list, list[tuple[int, int]], int]:
+        """Splits a line image into normalized glyphs, also returning their column ranges and the line's text height"""
+        import numpy as np
+        ink = ink_mask(line_img)
+        rows = np.flatnonzero(ink.any(axis=1))
+        if not len(rows): return [], [], 0
+
+        #crop every glyph to the rows of the whole line, so glyphs keep their vertical position (":" vs ".")
+        ink = ink[rows[0]:rows[-1]+1]
+        runs = segment(ink)
+        return [normalize(ink[:, start:end]) for start, end in runs], runs, ink.shape[0]
+
+    def add(self, line_img, text: str) -> bool:
+        """
+        Learns the glyphs of a line whose text is known, returning False if the line couldn't be split into one glyph per character
+        """
+        chars = text.replace(" ", "")
+        glyphs, runs, height = self._glyphs(line_img)
+        if not chars or len(glyphs) != len(chars): return False
+
+        for char, glyph, (start, end) in zip(chars, glyphs, runs):
+            if char in self._sums:
+                self._sums[char] = self._sums[char] + glyph
+            else:
+                self._sums[char] = glyph
+            self._widths[char] = self._widths.get(char, 0.0) + ((end - start) / height)
+            self._counts[char] = self._counts.get(char, 0) + 1
+        return True
+
+    def read(self, line_img) -> tuple[str, float]:
+        """
+        Reads a line of text, returning it along with the confidence (0-1) of the least certain character
+        """
+        import numpy as np
+        glyphs, runs, height = self._glyphs(line_img)
+        if not glyphs or not self._sums: return "", 0.0
+
+        chars = list(self._sums)
+        templates = np.array([self._sums[c] / self._counts[c] for c in chars])
+        templates = templates / np.maximum(np.linalg.norm(templates, axis=(1, 2), keepdims=True), 1e-6)
+        widths = np.array([self._widths[c] / self._counts[c] for c in chars])
+
+        text, confidence = "", 1.0
+        for i, (glyph, (start, end)) in enumerate(zip(glyphs, runs)):
+            #a gap wider than a third of the text height is a space
+            if i and (start - runs[i-1][1]) > height / 3: text += " "
+
+            #compare against every template, ruling out ones that are a very different width
+            scores = (templates * glyph).sum(axis=(1, 2))
+            scores[np.abs(widths - ((end - start) / height)) > 0.4] = -1
+            best = int(np.argmax(scores))
+            text += chars[best]
+            confidence = min(confidence, float(scores[best]))
+
+        return text, max(0.0, confidence)
@@ -0,0 +1,40 @@
+"""
+Fuzzy matching of OCR'd text against a fixed list of options (system names, tiers), using rapidfuzz
+Built once per detector worker, so the options only get processed once
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+@dataclass
+class Match():
+    name: str
+    index: int
+    score: float #normalized similarity to the OCR'd text, from 0 to 1
+    margin: float #how much better the score is than the runner-up's
+    runner_up: Optional[str]
+
+class NameMatcher():
+    """Picks the closest of a list of options to some (probably slightly wrong) OCR'd text"""
+    options: list[str]
+    _processed: list[str]
+
+    def __init__(self, options: list[str]):
+        self.options = list(options)
+        #OCR gets capitalization wrong fairly often, so matching is case insensitive
+        self._processed = [o.lower() for o in self.options]
+
+    def match(self, text: str) -> Match:
+        """Finds the closest option to `text`, along with how sure the match is"""
+        from rapidfuzz import process
+        from rapidfuzz.distance import Levenshtein
+
+        best, *rest = process.extract(
+            text.lower(), self._processed,
+            scorer=Levenshtein.normalized_similarity, limit=2
+        )
+        _, score, idx = best
+        runner_up_score = rest[0][1] if rest else 0.0
+        runner_up = self.options[rest[0][2]] if rest else None
+
+        return Match(self.options[idx], idx, score, score - runner_up_score, runner_up)
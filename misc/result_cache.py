@@ -0,0 +1,123 @@
+"""
+Caches detection results by the contents of the screenshot, so reposts of the same image skip the detector entirely
+Exact copies are matched by a hash of the file bytes, and (optionally) re-encoded copies by perceptual hashes of the pixels (of both the whole screenshot and the panel)
+"""
+
+import hashlib, time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Optional
+
+from misc.detector import Preview, Result #only imported lazily by the detector, so this isn't circular
+
+@dataclass
+class CacheEntry():
+    result: Result
+    preview: Preview
+    phash: Optional[int]
+    expires: float
+
+def content_hash(data: bytes) -> str:
+    """Hashes the raw bytes of a screenshot"""
+    return hashlib.sha256(data).hexdigest()
+
+def perceptual_hash(img, hash_size: int = 16) -> int:
+    """
+    Computes a difference hash (dHash) of a decoded image, which stays (nearly) the same when the image is re-encoded or resized
+    Each bit is whether a pixel is brighter than its right neighbour, on a tiny grayscale version of the image
+    """
+    import cv2 as cv
+    grey = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    small = cv.resize(grey, (hash_size + 1, hash_size), interpolation=cv.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+def panel_hash(img, panel: tuple[float, float, float]) -> Optional[int]:
+    """
+    Perceptual hash of the system info panel crop of a decoded screenshot, or None if the panel doesn't fit in it
+    The panel's position is given as fractions of the screenshot's size, so it lines up on resized copies too
+    """
+    height, width = img.shape[:2]
+    top_y, bottom_y, max_x = panel
+    crop = img[round(top_y * height):round(bottom_y * height), :round(max_x * width)]
+    if not crop.size: return None
+    return perceptual_hash(crop)
+
+class ResultCache():
+    """
+    LRU cache of detection results, with entries expiring after a set time
+    """
+    max_size: int
+    ttl: float
+    max_distance: int
+    hits: int
+    misses: int
+    _entries: OrderedDict[str, CacheEntry]
+
+    def __init__(self, max_size: int, ttl: float, max_distance: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def _purge(self):
+        """Evicts all expired entries"""
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e.expires <= now]:
+            del self._entries[key]
+
+    def _hit(self, key: str) -> tuple[Result, Preview]:
+        entry = self._entries[key]
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        #the stored capturable time was worked out when the screenshot was first detected, so it's still correct
+        #but if that time has passed since, the system is capturable right now
+        result = entry.result
+        if result.capturable and result.capturable <= time.time():
+            result = replace(result, capturable=None)
+        return replace(result), entry.preview
+
+    def get(self, digest: str) -> Optional[tuple[Result, Preview]]:
+        """Looks up a result by the content hash of the screenshot. Doesn't count as a miss, since the perceptual lookup may come after"""
+        self._purge()
+        if digest not in self._entries: return None
+        return self._hit(digest)
+
+    def get_similar(self, img, phash: int) -> Optional[tuple[Result, Preview]]:
+        """
+        Looks up a result by perceptual hash, for copies of a screenshot that were re-encoded
+        The panel is small compared to the whole screen, so the hashes of the panel crops have to match as well as the whole screenshots'
+        """
+        self._purge()
+        for key, entry in reversed(self._entries.items()):
+            if entry.phash is None or entry.result.panel is None or entry.result.panel_hash is None: continue
+            if (entry.phash ^ phash).bit_count() > self.max_distance: continue
+
+            candidate = panel_hash(img, entry.result.panel)
+            if candidate is not None and (entry.result.panel_hash ^ candidate).bit_count() <= self.max_distance:
+                return self._hit(key)
+        return None
+
+    def miss(self):
+        """Records a lookup that found nothing"""
+        self.misses += 1
+
+    def put(self, digest: str, phash: Optional[int], result: Result, preview: Preview):
+        """Adds a fresh detection result to the cache. The preview is shared with the caller, since it's never changed after encoding"""
+        self._purge()
+        self._entries[digest] = CacheEntry(replace(result), preview, phash, time.monotonic() + self.ttl)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0
+        }
@@ -0,0 +1,79 @@
+"""
+Timing of the individual stages of a detection (downloading, line search, OCR, etc.)
+StageTimer records the stages of a single detection, and TimingStats aggregates them over recent detections in the bot process
+"""
+
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class StageTimer():
+    """Records how long each stage of a single detection takes, in seconds"""
+    spans: dict[str, float]
+
+    def __init__(self):
+        self.spans = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the code inside the `with` block, adding it to the named stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + (time.perf_counter() - start)
+
+class TimingStats():
+    """
+    Rolling window of stage timings over the most recent detections
+    """
+    window: int
+    slow_threshold: float
+    count: int
+    _samples: dict[str, deque[float]]
+
+    #upper bounds (in seconds) of the histogram buckets
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, window: int = 200, slow_threshold: float = 0):
+        self.window = window
+        self.slow_threshold = slow_threshold
+        self.count = 0
+        self._samples = {}
+
+    def record(self, spans: dict[str, float]):
+        """Adds the stage timings of a detection, logging the breakdown if it was slow"""
+        self.count += 1
+        for stage, seconds in spans.items():
+            self._samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+        total = spans.get("total", 0.0)
+        if self.slow_threshold and total >= self.slow_threshold:
+            breakdown = ", ".join(f"{stage} {seconds*1000:.0f}ms" for stage, seconds in spans.items() if stage != "total")
+            print(f"Slow detection took {total:.1f}s: {breakdown}")
+
+    def percentile(self, stage: str, pct: float) -> float:
+        """Nearest-rank percentile of a stage's recent timings"""
+        ordered = sorted(self._samples.get(stage, ()))
+        if not ordered: return 0.0
+        return ordered[min(len(ordered)-1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+    def histogram(self, stage: str) -> list[int]:
+        """Counts of a stage's recent timings in each of the BUCKETS, with one extra bucket for anything slower"""
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for seconds in self._samples.get(stage, ()):
+            idx = next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound), len(self.BUCKETS))
+            counts[idx] += 1
+        return counts
+
+    def format_histogram(self, stage: str) -> str:
+        """Formats the non-empty buckets of a stage's histogram, e.g. <=0.1s: 12, <=0.25s: 3, >30s: 1"""
+        labels = [f"<={bound}s" for bound in self.BUCKETS] + [f">{self.BUCKETS[-1]}s"]
+        return ", ".join(f"{label}: {count}" for label, count in zip(labels, self.histogram(stage)) if count)
+
+    def summary(self) -> str:
+        """Multi-line summary of the p50/p95 and histogram of every stage, for logging"""
+        return "\n".join(
+            f"{stage}: p50 {self.percentile(stage, 50)*1000:.0f}ms, p95 {self.percentile(stage, 95)*1000:.0f}ms ({self.format_histogram(stage)})"
+            for stage in self._samples
+        )
@@ -0,0 +1,153 @@
+import asyncio
+import json, os
+from typing import Optional
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import DeleteMany, ReplaceOne
+
+from misc.atomic_write import atomic_write
+
+class Journal():
+    """
+    Write-behind persistence for the managers.
+    Database writes are appended to a local journal file (so they survive the bot dying), and flushed to Mongo in batches in the background.
+    The managers' in-memory systems are the source of truth for reads, so commands never wait on Mongo.
+    Anything still in the journal on startup wasn't flushed yet, so it gets replayed on top of what's loaded from Mongo.
+
+    Each line of the journal is one operation on a collection:
+    {"collection": "timers", "op": "upsert", "documents": [...]}
+    {"collection": "timers", "op": "delete", "names": [...]}
+    """
+    db: AsyncIOMotorDatabase
+    path: str
+    flush_delay: float #seconds to collect writes for before flushing them to Mongo together
+    retry_delay: float #seconds to wait before retrying a failed flush
+    fsync: bool #whether to make sure every write hits the disk before carrying on
+    seq: int #number of operations appended since startup, to tell which systems were written after some point
+    _pending: list[dict] #operations not flushed to Mongo yet, in order
+    _touched: dict[tuple[str, str], int] #(collection, name) -> seq of the last operation on that system
+    _file: object
+    _wakeup: asyncio.Event
+    _task: Optional[asyncio.Task]
+
+    @classmethod
+    async def new(cls, db: AsyncIOMotorDatabase, path: str, config: dict):
+        """Opens the journal, loading any operations that weren't flushed last time, and starts flushing"""
+        self = cls()
+        self.db = db
+        self.path = path
+        self.flush_delay = config.get("flush_delay", 1)
+        self.retry_delay = config.get("retry_delay", 5)
+        self.fsync = config.get("fsync", True)
+        self.seq = 0
+        self._touched = {}
+
+        #load the operations left over from last time, ignoring a partly written last line if the bot died mid-write
+        self._pending = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        self._pending.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        if self._pending: print(f"Replaying {len(self._pending)} unflushed database writes from the journal")
+
+        #rewrite the journal with just the valid operations, and keep it open for appending
+        self._rewrite()
+
+        self._wakeup = asyncio.Event()
+        if self._pending: self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def pending(self, collection: str) -> list[dict]:
+        """Gets the unflushed operations on a collection, in order"""
+        return [op for op in self._pending if op["collection"] == collection]
+
+    def pending_names(self, collection: str) -> set[str]:
+        """Gets the names of the systems in a collection that have unflushed operations"""
+        return {
+            name
+            for op in self.pending(collection)
+            for name in (op["names"] if op["op"] == "delete" else [d["name"] for d in op["documents"]])
+        }
+
+    def has_pending(self, collection: str, name: str) -> bool:
+        """Checks if there are unflushed operations on a system (by name) in a collection"""
+        return any(
+            op["collection"] == collection and
+            (name in op["names"] if op["op"] == "delete" else any(d["name"] == name for d in op["documents"]))
+            for op in self._pending
+        )
+
+    def touched_since(self, collection: str, name: str, seq: int) -> bool:
+        """Checks if a system (by name) in a collection was written after `seq`, even if that write has been flushed already"""
+        return self._touched.get((collection, name), 0) > seq
+
+    def _append(self, op: dict):
+        """Durably adds an operation to the journal, and schedules it to be flushed"""
+        self._file.write(json.dumps(op) + "\n") #type:ignore
+        self._file.flush() #type:ignore
+        if self.fsync: os.fsync(self._file.fileno()) #type:ignore
+        self._pending.append(op)
+
+        self.seq += 1
+        names = op["names"] if op["op"] == "delete" else [d["name"] for d in op["documents"]]
+        for name in names:
+            self._touched[(op["collection"], name)] = self.seq
+        self._wakeup.set()
+
+    def upsert(self, collection: str, documents: list[dict]):
+        """Records documents to be inserted (or replaced, by name) in a collection"""
+        if documents: self._append({"collection": collection, "op": "upsert", "documents": documents})
+
+    def delete(self, collection: str, names: list[str]):
+        """Records documents to be deleted (by name) from a collection"""
+        if names: self._append({"collection": collection, "op": "delete", "names": names})
+
+    def _rewrite(self):
+        """Replaces the journal file with just the pending operations, all at once"""
+        if getattr(self, "_file", None): self._file.close() #type:ignore
+
+        with atomic_write(self.path, fsync=self.fsync) as f:
+            f.writelines(json.dumps(op) + "\n" for op in self._pending)
+
+        self._file = open(self.path, "a")
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            #wait a bit so writes made close together get flushed together
+            await asyncio.sleep(self.flush_delay)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Couldn't flush the journal to the database, retrying in {self.retry_delay}s: {e}")
+                self._wakeup.set()
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush(self):
+        """Writes all the pending operations to Mongo, with one ordered bulk write per run of operations on the same collection"""
+        batch = list(self._pending)
+        if not batch: return
+
+        #group consecutive operations on the same collection together, keeping everything in order
+        #so moves between collections still write the target before deleting from the source
+        runs: list[tuple[str, list]] = []
+        for op in batch:
+            if not runs or runs[-1][0] != op["collection"]:
+                runs.append((op["collection"], []))
+            requests = runs[-1][1]
+            if op["op"] == "upsert":
+                requests.extend(ReplaceOne(filter={"name": d["name"]}, replacement=d, upsert=True) for d in op["documents"])
+            else:
+                requests.append(DeleteMany({"name": {"$in": op["names"]}}))
+
+        for collection, requests in runs:
+            await self.db[collection].bulk_write(requests, ordered=True)
+
+        #everything in the batch is in Mongo now, so it can be dropped from the journal
+        #(nothing else touches the pending list between here and the rewrite, so new writes are kept)
+        self._pending = self._pending[len(batch):]
+        self._rewrite()
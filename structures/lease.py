@@ -0,0 +1,99 @@
+import asyncio
+import os, socket, time, uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+def load_holder(path: str) -> str:
+    """Loads this instance's lease holder id, making a new random one the first time"""
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            holder = f.read().strip()
+        if holder: return holder
+
+    #random, so two processes on the same machine (with their own cache directories) never both think they're the leader
+    holder = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(holder)
+    return holder
+
+class Lease():
+    """
+    Decides which of the bot's running instances is the leader, using a lease document in Mongo.
+    Only the leader expires timers and renders the main message, every instance keeps its systems in sync and handles commands.
+    The leader keeps renewing the lease, if it stops (the instance died or lost its connection) another instance takes over once it expires.
+    With the lease disabled in the config, this instance is always the leader, for running a single instance without depending on Mongo for it.
+    """
+    collection: AsyncIOMotorCollection
+    name: str
+    holder: str #this instance's id
+    ttl: float #seconds the lease lasts without being renewed
+    is_held: bool
+    _expires: float #monotonic time our lease runs out at, if it isn't renewed again
+    on_acquired: Optional[Callable[[], Awaitable[None]]]
+    _task: Optional[asyncio.Task]
+
+    @classmethod
+    async def new(cls, collection: AsyncIOMotorCollection, holder_path: str, config: dict, on_acquired: Optional[Callable[[], Awaitable[None]]] = None):
+        """
+        Starts taking (and then renewing) the lease in the background
+        This instance's id is kept in `holder_path`, so a restarted instance takes its own lease back straight away instead of waiting for it to expire
+        """
+        self = cls()
+        self.collection = collection
+        self.name = config.get("name", "leader")
+        self.holder = config.get("holder") or load_holder(holder_path)
+        self.ttl = config.get("ttl", 30)
+        self.is_held = False
+        self._expires = 0.0
+        self.on_acquired = on_acquired
+
+        if not config.get("enabled", True):
+            print("Leader lease is disabled, running as the only instance")
+            self.is_held = True
+            self._task = asyncio.create_task(self.on_acquired()) if self.on_acquired else None
+            return self
+
+        #take the lease in the background, so startup isn't held up if the db can't be reached
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def _renew(self):
+        """Takes or renews the lease if it's free (or already ours), noting whether this instance holds it"""
+        now = datetime.now(timezone.utc)
+        started = time.monotonic()
+        try:
+            #a lease held by someone else that hasn't expired doesn't match the filter, so the upsert fails on the duplicate _id
+            document = await self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"holder": self.holder}, {"expires": {"$lt": now}}]},
+                {"$set": {"holder": self.holder, "expires": now + timedelta(seconds=self.ttl)}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+            held = document is not None and document["holder"] == self.holder
+        except DuplicateKeyError:
+            held = False
+
+        if held: self._expires = started + self.ttl
+        acquired = held and not self.is_held
+        if self.is_held and not held: print("Lost the leader lease, another instance took over")
+        self.is_held = held
+        if acquired:
+            print(f"Acquired the leader lease as {self.holder}")
+            if self.on_acquired: await self.on_acquired()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._renew()
+            except Exception as e:
+                #a lease that hasn't run out yet is still ours, so one failed renewal doesn't stop this instance leading
+                #but once it could have expired, assume it's lost rather than risk two leaders
+                print(f"Couldn't renew the leader lease: {e}")
+                if self.is_held and time.monotonic() >= self._expires:
+                    print("Leader lease expired without being renewed, stepping down")
+                    self.is_held = False
+            #renew well before the lease expires, so it doesn't lapse from a slow round trip
+            await asyncio.sleep(self.ttl / 3)
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib, json, time
+from typing import Optional
+from interactions import Client, Embed, GuildText, Message
+
+class RenderScheduler():
+    """
+    Coalesces updates to the main tracker message, which is shared by the timer and capturable managers.
+    Managers mark themselves dirty when they change, and all the changes made within a short window get rendered in a single edit.
+    The whole message is rendered from the managers' in-memory state, so it never has to be read back from discord.
+    """
+    bot: Client
+    delay: float #seconds to wait for more changes before editing
+    min_interval: float #minimum seconds between edits, so bursts of changes don't get the message edit route rate limited
+    retry_delay: float #seconds to wait before retrying a failed edit
+    _channel: GuildText
+    _message: Optional[Message] #cached handle to the main message
+    _last_payload: Optional[str] #hash of the last embeds sent, to skip edits that wouldn't change anything
+    _managers: list #managers in the order their embeds appear in the message
+    _dirty: set
+    _last_edit: float
+    _task: Optional[asyncio.Task]
+    _lock: asyncio.Lock
+
+    @classmethod
+    async def new(cls, bot: Client):
+        """Creates a new render scheduler, fetching the main channel"""
+        self = cls()
+        self.bot = bot
+
+        config = self.bot.config.get("render", {})
+        self.delay = config.get("delay", 0.5)
+        self.min_interval = config.get("min_interval", 2)
+        self.retry_delay = config.get("retry_delay", 5)
+
+        channel = await self.bot.fetch_channel(self.bot.config["main_channel"])
+        if not isinstance(channel, GuildText): raise TypeError("Wrong channel type for render scheduler!")
+        self._channel = channel
+        self._message = None
+        self._last_payload = None
+
+        self._managers = []
+        self._dirty = set()
+        self._last_edit = 0.0
+        self._task = None
+        self._lock = asyncio.Lock()
+        return self
+
+    def register(self, manager):
+        """Adds a manager whose embed is part of the message, in order"""
+        self._managers.append(manager)
+
+    def mark_dirty(self, manager):
+        """Notes that a manager has changed, scheduling an edit of the message if there isn't one already"""
+        self._dirty.add(manager)
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        """Keeps rendering the message until there are no more changes to render"""
+        while self._dirty:
+            #wait a bit so changes made close together end up in the same edit, and don't edit more often than min_interval
+            await asyncio.sleep(max(self.delay, self._last_edit + self.min_interval - time.monotonic()))
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Couldn't update the main message, retrying in {self.retry_delay}s: {e}")
+                await asyncio.sleep(self.retry_delay)
+
+    async def get_message(self) -> Message:
+        """Gets the main message, only fetching it the first time"""
+        if self._message: return self._message
+
+        msg = await self._channel.fetch_message(self.bot.config["main_message"])
+        if msg == None: #make sure message could be fetched
+            raise RuntimeError("Couldn't fetch the main message for RenderScheduler")
+
+        self._message = msg
+        return msg
+
+    def render(self) -> list[Embed]:
+        """Renders the embeds of every manager, in order, skipping managers with nothing to show"""
+        return [embed for manager in self._managers if (embed := manager.render())]
+
+    async def flush(self):
+        """Immediately renders any pending changes into the message, with one edit"""
+        async with self._lock:
+            if not self._dirty: return
+            dirty, self._dirty = self._dirty, set()
+
+            #only the leader instance edits the message, it renders the same (synced) systems
+            if not self.bot.lease.is_held: return
+            try:
+                embeds = self.render()
+
+                #skip the edit if the message already shows exactly this
+                payload = hashlib.sha256(json.dumps([e.to_dict() for e in embeds], sort_keys=True, default=str).encode()).hexdigest()
+                if payload == self._last_payload: return
+
+                message = await self.get_message()
+                await message.edit(embeds=embeds)
+                self._last_payload = payload
+                self._last_edit = time.monotonic()
+            except Exception:
+                #keep the changes around, so the next flush renders them, and fetch the message again in case it was the problem
+                self._dirty |= dirty
+                self._message = None
+                self._last_edit = time.monotonic()
+                raise
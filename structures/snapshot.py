@@ -0,0 +1,68 @@
+import asyncio
+import json, os
+from typing import Optional
+
+from misc.atomic_write import atomic_write
+
+class Snapshot():
+    """
+    Local snapshot of every manager's systems, so the bot can start serving straight away without waiting on a full read of Mongo.
+    Rewritten shortly after every change, and read by the managers on startup (which then reconcile with Mongo in the background).
+
+    The file is a JSON object of collection name -> list of system documents:
+    {"timers": [...], "capturable": [...]}
+    """
+    path: str
+    delay: float #seconds to wait for more changes before writing the snapshot
+    _managers: list
+    _loaded: Optional[dict[str, list[dict]]]
+    _task: Optional[asyncio.Task]
+
+    @classmethod
+    def new(cls, path: str, config: dict):
+        """Loads the snapshot from the last run, if there is one"""
+        self = cls()
+        self.path = path
+        self.delay = config.get("delay", 1)
+        self._managers = []
+        self._task = None
+
+        self._loaded = None
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self._loaded = json.loads(f.read())
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Couldn't load the snapshot, loading from the database instead: {e}")
+        return self
+
+    def documents(self, collection: str) -> Optional[list[dict]]:
+        """Gets the snapshotted documents of a collection, or None if there's no snapshot of it"""
+        if self._loaded is None: return None
+        return self._loaded.get(collection)
+
+    def register(self, manager):
+        """Adds a manager whose systems are part of the snapshot"""
+        self._managers.append(manager)
+
+    def schedule(self):
+        """Schedules the snapshot to be written, if it isn't already"""
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        #wait a bit so changes made close together only cause one write
+        await asyncio.sleep(self.delay)
+        try:
+            self.write()
+        except OSError as e:
+            print(f"Couldn't write the snapshot: {e}")
+
+    def write(self):
+        """Writes the snapshot, replacing the old one all at once"""
+        data = {
+            manager.collection.name: [s.to_document() for s in manager._systems.values()]
+            for manager in self._managers
+        }
+        with atomic_write(self.path) as f:
+            f.write(json.dumps(data))
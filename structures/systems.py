@@ -1,7 +1,9 @@
-from typing import Optional
-from dataclasses import dataclass
+import asyncio, enum, heapq, time
+from typing import Awaitable, Callable, Optional
+from dataclasses import dataclass, field
 from motor.motor_asyncio import AsyncIOMotorCollection
-from interactions import Embed, Guild, GuildText, Message, Client
+from pymongo.errors import OperationFailure
+from interactions import Embed, Client
 from interactions.client.utils import bold
 
 from misc.colors import KAVANI_COLOR
@@ -12,40 +14,99 @@ Timestamp = int
 UserId    = int
 MessageId = int
 
-@dataclass
+class Tier(enum.IntEnum):
+    """A system's defense tier, stored in the DB as its int value"""
+    NewClaim = 0
+    Outpost = 1
+    Garrison = 2
+    Stronghold = 3
+
+class Owner(str, enum.Enum):
+    """The faction that owns a system, stored in the DB as its name"""
+    Lycentian = "Lycentian"
+    Foralkan = "Foralkan"
+
+TIER_NAMES = ("New Claim", "Outpost", "Garrison", "Stronghold")
+OWNER_EMOJIS = {
+    Owner.Foralkan: "<:Foralkus:1227736614432936057>",
+    Owner.Lycentian: "<:Lycentia:1222626949457772695>"
+}
+#the rendered string (cached on the System) that each field is part of
+RENDERED_BY_FIELD = {
+    "name": "_system_data", "owner": "_system_data", "tier": "_system_data",
+    "capturable": "_capture_data",
+    "added": "_added_data", "added_by": "_added_data"
+}
+
+@dataclass(slots=True)
 class System():
     """
     Represents a Contested system, and data about its addition to the DB
+    The rendered strings are built once and kept until one of the fields they show changes
     """
     name: str
-    owner: str
-    tier: int
+    owner: Owner
+    tier: Tier
     capturable: Timestamp
     added: Timestamp
     added_by: UserId
     message_id: Optional[MessageId]
+    _system_data: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    _capture_data: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    _added_data: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        #accept the plain values too (from the DB, or commands)
+        self.owner = Owner(self.owner)
+        self.tier = Tier(self.tier)
+
+    def __setattr__(self, name: str, value):
+        object.__setattr__(self, name, value)
+        #a change to a field makes the rendered string it's part of stale
+        rendered = RENDERED_BY_FIELD.get(name)
+        if rendered: object.__setattr__(self, rendered, None)
+
+    @classmethod
+    def from_document(cls, document: dict) -> "System":
+        """Creates a system from its DB document"""
+        return cls(
+            document["name"], document["owner"], document["tier"], document["capturable"],
+            document["added"], document["added_by"], document.get("message_id")
+        )
+
+    def to_document(self) -> dict:
+        """Gets the DB document for this system, with only plain types"""
+        return {
+            "name": self.name,
+            "owner": self.owner.value,
+            "tier": int(self.tier),
+            "capturable": self.capturable,
+            "added": self.added,
+            "added_by": self.added_by,
+            "message_id": self.message_id
+        }
 
     def get_tier(self) -> str:
         """Gets the string version of this system's tier"""
-        return [
-            "New Claim",
-            "Outpost",
-            "Garrison",
-            "Stronghold"
-        ][self.tier]
+        return TIER_NAMES[self.tier]
     
     def get_system_data(self) -> str:
         """Gets string containing information about system"""
-        emoji = '<:Foralkus:1227736614432936057>' if self.owner == 'Foralkan' else '<:Lycentia:1222626949457772695>'
-        return f"{emoji} {self.name} [{self.get_tier()}]"
+        if self._system_data is None:
+            self._system_data = f"{OWNER_EMOJIS[self.owner]} {self.name} [{self.get_tier()}]"
+        return self._system_data
     
     def get_capture_data(self) -> str:
         """Gets string containing information about capturability"""
-        return f"<t:{self.capturable}:R>, at <t:{self.capturable}:t>"
+        if self._capture_data is None:
+            self._capture_data = f"<t:{self.capturable}:R>, at <t:{self.capturable}:t>"
+        return self._capture_data
     
     def get_added_data(self) -> str:
         """Gets string containing information about this system's addition to the DB"""
-        return f"<@{self.added_by}>, on <t:{self.added}:f>"
+        if self._added_data is None:
+            self._added_data = f"<@{self.added_by}>, on <t:{self.added}:f>"
+        return self._added_data
     
 
 class BaseManager():
@@ -56,7 +117,10 @@ class BaseManager():
     bot: Client
     collection: AsyncIOMotorCollection
     _systems: dict[str, System]
-    _channel: GuildText
+    _ids: dict[object, str] #mongo _id -> system name, since change stream delete events only have the _id
+    _loaded_at: object #db operation time the systems were last read from the db at, to start syncing changes from
+    _sync_task: Optional[asyncio.Task]
+    _reconcile_task: Optional[asyncio.Task]
 
     @classmethod
     async def new(cls, bot: Client, collection: AsyncIOMotorCollection):
@@ -67,33 +131,157 @@ class BaseManager():
         self.bot = bot
         self.collection = collection
         self._systems = {}
+        self._ids = {}
+        self._loaded_at = None
+        self._sync_task = None
+        self._reconcile_task = None
 
-        #initialize the systems from the db
-        async for document in self.collection.find(projection={"_id": False}):
-            self._systems[document["name"]] = System(**document)
-
-        #fetch the main guild
-        guild = await self.bot.fetch_guild(self.bot.config["main_guild"])
-        if not guild: raise RuntimeError("Could not fetch guild for manager!")
+        #initialize the systems from the local snapshot if there is one, so the bot can start straight away, reconciling with the db in the background
+        #otherwise from the db. then replay the writes that didn't make it to the db yet on top
+        snapshot = self.bot.snapshot.documents(self.collection.name)
+        if snapshot is not None:
+            for document in snapshot:
+                self._systems[document["name"]] = System.from_document(document)
+            self._reconcile_task = asyncio.create_task(self.reconcile())
+        else:
+            for document in await self._load():
+                self._ids[document.pop("_id")] = document["name"]
+                self._systems[document["name"]] = System.from_document(document)
+        for op in self.bot.journal.pending(self.collection.name):
+            if op["op"] == "upsert":
+                for document in op["documents"]:
+                    self._systems[document["name"]] = System.from_document(document)
+            else:
+                for name in op["names"]:
+                    self._systems.pop(name, None)
 
-        #fetch the main channel with some typechecking shenanigans
-        _channel = await guild.fetch_channel(self.bot.config["main_channel"])
-        if not isinstance(_channel, GuildText): raise TypeError("Wrong channel type for manager!")
-        self._channel = _channel 
+        #render this manager's embed in the main message, through the bot's render scheduler, and keep it in the snapshot
+        self.bot.renderer.register(self)
+        self.bot.snapshot.register(self)
 
         return self
-        
 
-    async def fetch_message(self) -> Message:
-        """Freshly fetches the discord message for this manager"""
-        msg = await self._channel.fetch_message(self.bot.config["main_message"], force=True)
-        if msg == None: #make sure message could be fetched
-            raise RuntimeError("Couldn't fetch the main message for TimerManager")
-        
-        return msg
-    
+    async def _load(self) -> list[dict]:
+        """Reads every document in the collection, noting the db's time from just before the read so syncing can start from there"""
+        async with await self.collection.database.client.start_session() as session:
+            #any command gives the session the db's current operation time, changes from then on are all synced (some maybe twice, which is harmless)
+            await self.collection.database.command("ping", session=session)
+            loaded_at = session.operation_time
+            documents = [document async for document in self.collection.find(session=session)]
+        self._loaded_at = loaded_at
+        return documents
+
+    async def reconcile(self):
+        """
+        Applies any differences between the db and the in-memory systems (loaded from the snapshot), retrying until the db can be read.
+        Systems with writes still waiting in the journal are left alone, since those are newer than the db.
+        So are systems written while the db was being read, or waiting in the journal when the read started (like writes replayed from the last run),
+        as the read may not have seen them even if they're flushed by now.
+        """
+        while True:
+            try:
+                seq = self.bot.journal.seq
+                pending = self.bot.journal.pending_names(self.collection.name)
+                documents = await self._load()
+                break
+            except Exception as e:
+                print(f"Couldn't read {self.collection.name} to reconcile the snapshot, retrying: {e}")
+                await asyncio.sleep(5)
+
+        remote: dict[str, System] = {}
+        for document in documents:
+            self._ids[document.pop("_id")] = document["name"]
+            remote[document["name"]] = System.from_document(document)
+
+        def is_newer(name: str) -> bool:
+            return (
+                name in pending or self.bot.journal.has_pending(self.collection.name, name) or
+                self.bot.journal.touched_since(self.collection.name, name, seq)
+            )
+
+        changed, removed = [], []
+        for name, system in remote.items():
+            if is_newer(name) or self._systems.get(name) == system: continue
+            self._systems[name] = system
+            changed.append(system)
+        for name in [n for n in self._systems if n not in remote]:
+            if is_newer(name): continue
+            del self._systems[name]
+            removed.append(name)
+
+        if not changed and not removed: return
+        print(f"Reconciled {self.collection.name} with the db: {len(changed)} added/changed, {len(removed)} removed")
+        self._changed(changed)
+        await self.update_message()
+
+    def start_sync(self):
+        """
+        Starts applying the changes other instances of the bot make to this manager's collection, using a change stream.
+        Needs Mongo to be running as a replica set (a single node one works too).
+        The stream starts from when the systems were loaded, so changes made between the load and this being called aren't missed.
+        """
+        self._sync_task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        #when loaded from the snapshot, wait for the db read to be reconciled first, and sync from when it happened
+        if self._reconcile_task: await self._reconcile_task
+
+        resume_token = None
+        while True:
+            try:
+                start_at = None if resume_token else self._loaded_at
+                async with self.collection.watch(full_document="updateLookup", resume_after=resume_token, start_at_operation_time=start_at) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        await self._apply_change(change)
+            except OperationFailure as e:
+                #change streams aren't supported on standalone servers, so there's nothing to sync with
+                if e.code == 40573:
+                    print(f"Change streams aren't supported by the database, not syncing {self.collection.name}")
+                    return
+                print(f"Syncing {self.collection.name} errored with this message, retrying: {e}")
+                await asyncio.sleep(5)
+            except Exception as e:
+                print(f"Syncing {self.collection.name} errored with this message, retrying: {e}")
+                await asyncio.sleep(5)
+
+    async def _apply_change(self, change: dict):
+        """Applies a change stream event to the in-memory systems"""
+        if change["operationType"] in ("insert", "replace", "update"):
+            document = change.get("fullDocument")
+            if not document: return #deleted again before the lookup
+            self._ids[document.pop("_id")] = document["name"]
+            system = System.from_document(document)
+
+            #skip our own writes coming back, and writes that local changes waiting in the journal will overwrite anyway
+            if self.bot.journal.has_pending(self.collection.name, system.name): return
+            if self._systems.get(system.name) == system: return
+            self._systems[system.name] = system
+            self._changed([system])
+        elif change["operationType"] == "delete":
+            name = self._ids.pop(change["documentKey"]["_id"], None)
+            if name is None or name not in self._systems: return
+            if self.bot.journal.has_pending(self.collection.name, name): return
+            del self._systems[name]
+            self._changed([])
+        else: return
+
+        await self.update_message()
+
+    def _changed(self, systems: list[System]):
+        """Called after systems are added (`systems`) or removed, for children classes to keep their own state up to date"""
+        pass
+
     async def update_message(self):
-        """Updates the discord message for this manager with new information."""
+        """
+        Schedules the discord message to be updated with this manager's new information, and the snapshot to be rewritten.
+        Changes made close together are rendered in a single edit, by the bot's render scheduler.
+        """
+        self.bot.renderer.mark_dirty(self)
+        self.bot.snapshot.schedule()
+
+    def render(self) -> Optional[Embed]:
+        """Renders this manager's embed from its systems, or None if it shouldn't be shown"""
         pass #must be defined in child classes
     
     async def add(self, system: System, log: bool = True):
@@ -101,36 +289,72 @@ class BaseManager():
         Adds the specified system to the manager. 
         Implicitly updates the manager's message and logs the addition, as well.
         """
-        self._systems[system.name] = system
-        await self.collection.replace_one(
-            filter={"name": system.name},
-            replacement=system.__dict__,
-            upsert=True
-        )
+        await self.add_many([system], log)
+
+    async def add_many(self, systems: list[System], log: bool = True):
+        """
+        Adds a batch of systems to the manager, with a single (journaled) database write and message update.
+        Logs all the additions in one message, as well.
+        """
+        if not systems: return
+        for system in systems:
+            self._systems[system.name] = system
+        self.bot.journal.upsert(self.collection.name, [s.to_document() for s in systems])
+        self._changed(systems)
 
         await self.update_message()
 
-        #log the addition as an embed
+        #log the additions as embeds, 10 per message since that's discord's limit
         if not log: return #make sure we actually want to
+        embeds = [self._addition_embed(s) for s in systems]
+        for i in range(0, len(embeds), 10):
+            await self.bot.logging.log(embeds=embeds[i:i+10])
+
+    def _addition_embed(self, system: System) -> Embed:
+        """Creates the embed for logging a system's addition"""
         capturable_message = "*Immediately*" if system.capturable == system.added else system.get_capture_data()
-        embed = Embed(
+        return Embed(
             title="System added:", color=KAVANI_COLOR,
             description=system.get_system_data()
         )\
             .add_field("Capturable", capturable_message, True)\
             .add_field("Added by", system.get_added_data(), True)
-        await self.bot.logging.log(embeds=[embed])
 
     async def remove(self, name: str):
         """
         Removes a system from the manager, searching by name
         Automatically updates the associated discord message
         """
-        del self._systems[name]
-        await self.collection.delete_one({"name": name})
+        await self.remove_many([name])
+
+    async def remove_many(self, names: list[str]):
+        """
+        Removes a batch of systems from the manager by name, with a single (journaled) database write and message update.
+        Repeated or missing names are fine, so the batch is never left half removed.
+        """
+        names = list(dict.fromkeys(names))
+        if not names: return
+        for name in names:
+            self._systems.pop(name, None)
+        self.bot.journal.delete(self.collection.name, names)
+        self._changed([])
 
         await self.update_message()
 
+    async def move_many(self, systems: list[System], target: "BaseManager", log: bool = False):
+        """
+        Moves a batch of systems from this manager into another one, with one database write per collection.
+        The systems are added to the target before being removed from here, so if the bot dies in between
+        they're in both collections (which gets cleaned up by `remove_duplicates` on startup), rather than lost.
+        """
+        if not systems: return
+        await target.add_many(systems, log)
+        await self.remove_many([s.name for s in systems])
+
+    async def remove_duplicates(self, target: "BaseManager"):
+        """Removes systems that are also in `target`, which are left over from moves that got interrupted"""
+        await self.remove_many([name for name in self._systems if target.has(name)])
+
     def get(self, name: str) -> Optional[System]:
         """Gets a system from the manager by name"""
         if name not in self._systems: return None
@@ -143,49 +367,107 @@ class BaseManager():
 class CapturableManager(BaseManager):
     """Manager respresenting currently capturable FW systems"""
 
-    async def update_message(self):
+    def render(self) -> Optional[Embed]:
         """
-        Updates this manager's message embed with fresh information.
+        Renders this manager's embed with fresh information.
         """
-        #get the message
-        message = await self.fetch_message()
-        
-        #if there are no capturable systems, exit early
-        if not self._systems:
-            #if the message has a "capturable" embed, remove it, but keep the "timers" one
-            if len(message.embeds) == 2:
-                await message.edit(embeds=message.embeds[0])
-            return
+        #if there are no capturable systems, there's no "capturable" embed, just the "timers" one
+        if not self._systems: return None
 
         #create the new embed
         embed = Embed(title="Capturable:", color=KAVANI_COLOR)
         embed.description = "\n".join(map(lambda s: s.get_system_data(), self._systems.values()))
         embed.description = bold(embed.description)
-
-        #update the existing message with the new embed, keeping the other embed from the TimerManager
-        await message.edit(embeds=[message.embeds[0], embed])
+        return embed
 
 class TimerManager(BaseManager):
     """Manager respresenting soon-to-be capturable FW systems."""
+    _expiries: list[tuple[Timestamp, str]] #heap of (capturable, name), entries for removed timers are skipped when they come up
+    _queued: dict[str, Timestamp] #name -> capturable of the latest heap entry for each timer, so unchanged timers aren't pushed again
+    _wakeup: asyncio.Event
+    _expiry_task: Optional[asyncio.Task]
 
-    async def update_message(self):
-        #get the message
-        message = await self.fetch_message()
+    def start_expiry(self, on_expired: Callable[[list[System]], Awaitable[None]]):
+        """
+        Starts calling `on_expired` with the timers that have become capturable, right when they do.
+        Timers that become capturable at the same time are handled together, in one batch.
+        """
+        self._queued = {t.name: t.capturable for t in self._systems.values()}
+        self._expiries = [(capturable, name) for name, capturable in self._queued.items()]
+        heapq.heapify(self._expiries)
+        self._wakeup = asyncio.Event()
+        self._expiry_task = asyncio.create_task(self._expire(on_expired))
+
+    def _is_current(self, expiry: tuple[Timestamp, str]) -> bool:
+        """Checks that a heap entry is still for a timer in the manager, and hasn't been changed since"""
+        timer = self._systems.get(expiry[1])
+        return timer is not None and timer.capturable == expiry[0]
+
+    def _push(self, timer: System):
+        """Adds a heap entry for a timer, unless its latest entry already has the same capturable time"""
+        if self._queued.get(timer.name) == timer.capturable: return
+        self._queued[timer.name] = timer.capturable
+        heapq.heappush(self._expiries, (timer.capturable, timer.name))
+
+    async def _expire(self, on_expired: Callable[[list[System]], Awaitable[None]]):
+        while True:
+            self._wakeup.clear()
+
+            #only the leader instance expires timers, the others just follow along through the change streams
+            if not self.bot.lease.is_held:
+                await self._wakeup.wait()
+                continue
+
+            #pop every timer that's due, dropping entries for ones that were removed
+            #a timer can still have two current entries (if its time was changed and then changed back), so only take it once
+            now = time.time()
+            due, seen = [], set()
+            while self._expiries and (self._expiries[0][0] <= now or not self._is_current(self._expiries[0])):
+                expiry = heapq.heappop(self._expiries)
+                if self._queued.get(expiry[1]) == expiry[0]: del self._queued[expiry[1]]
+                if self._is_current(expiry) and expiry[1] not in seen:
+                    seen.add(expiry[1])
+                    due.append(self._systems[expiry[1]])
+
+            if due:
+                try:
+                    await on_expired(due)
+                except Exception as e:
+                    #put the timers that are still here back on the heap, so they get retried instead of never expiring
+                    print(f"Handling expired timers errored with this message, retrying in 5s: {e}")
+                    for timer in due:
+                        self._push(timer)
+                    await asyncio.sleep(5)
+                continue
+
+            #sleep until the next timer is due, or a timer gets added/removed
+            timeout = (self._expiries[0][0] - now) if self._expiries else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError: pass
+
+    def wake(self):
+        """Makes the expiry task check for due timers again, e.g. after this instance becomes the leader"""
+        self._changed([])
+
+    def _changed(self, systems: list[System]):
+        """Adds timers to the expiry heap (if it's running), and wakes it up to work out its next sleep"""
+        if not getattr(self, "_expiry_task", None): return
+        for timer in systems:
+            self._push(timer)
+        self._wakeup.set()
 
-        #get existing embeds, and begin to create a new one
-        other_embeds = message.embeds[1:]
+    def render(self) -> Optional[Embed]:
         embed = Embed(title="Timers:", color=KAVANI_COLOR)
 
         #if there are no timers, note that in the embed, and exit early
         if not self._systems:
             timer_id = self.bot.interactions_by_scope[0]["timer"].cmd_id[0]
             embed.description = f"There are currently no timers set!\nYou can set one with </timer:{timer_id}>"
-            await message.edit(embeds=[embed, *other_embeds])
-            return
+            return embed
         
         #add the timers to the embed
         for timer in self._systems.values():
             embed.add_field(timer.get_system_data(), timer.get_capture_data())
 
-        #edit the message with the new embed
-        await message.edit(embeds=[embed, *other_embeds])
\ No newline at end of file
+        return embed